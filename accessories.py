@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+import itertools
+import collections
+
+CHECKED_OUT = 'CHECKED_OUT'
+
+# Kinds every desk has, with the config.json keys their totals are under
+BUILTIN = (('headset', 'headsets'), ('battery', 'batteries'))
+
+
+def plural(kind):
+    if kind.endswith('y') and kind[-2:-1] not in 'aeiou':
+        return kind[:-1] + 'ies'
+    return kind + 's'
+
+
+def read_db(data):
+    """
+Returns ({kind: loans out}, history) from a database in the radios.json
+layout. Databases saved before every kind shared one history kept 'headsets'
+and 'batteries' lists and a history for each, without the entries saying
+what they were.
+    """
+    if 'accessories' in data:
+        return data['accessories'], data.get('accessory_history', [])
+
+    loans, history = {}, []
+    for kind, key in BUILTIN:
+        out = data.get(key, [])
+        # Even older databases only counted headsets
+        loans[kind] = [dict(entry, type=kind) for entry in out] if isinstance(out, list) else []
+        history.extend(dict(entry, type=kind) for entry in data.get(kind + '_history', []))
+
+    history.sort(key=lambda entry: entry['time'])
+    return loans, history
+
+
+def open_loans(entries):
+    """
+Positions of the checkouts in an accessory history (every kind, in the order
+applied) that were never returned. Returns close the borrower's oldest loan
+of that kind, as in the pools.
+    """
+    queues = {}
+    for i, entry in enumerate(entries):
+        queue = queues.setdefault((entry['type'], entry['borrower']), collections.deque())
+        if entry['status'] == CHECKED_OUT:
+            queue.append(i)
+        elif queue:
+            queue.popleft()
+    return sorted(i for queue in queues.values() for i in queue)
+
+
+
+class Pool(object):
+    """
+One kind of accessory: headsets, batteries, chargers... They're all alike,
+so instead of tracking units the pool keeps counts: how many there are, and
+how many each borrower and department has out.
+
+Each loan is filed under a key, unique within the pool, in `loans` (in the
+order they went out) and in its borrower's queue. A return closes the
+borrower's oldest loan, so checking out and in are a handful of dict and
+deque operations however many loans are out.
+    """
+
+    def __init__(self, kind, total=0):
+        self.kind = kind
+        self.plural = plural(kind)
+        self.total = total
+        self.load([])
+
+    def load(self, entries):
+        self.loans = {}
+        self.borrowers = {}
+        self.departments = collections.Counter()
+        self.keys = itertools.count()
+
+        for entry in entries:
+            self.checkout(entry)
+
+    def __len__(self):
+        return len(self.loans)
+
+    def available(self):
+        # Negative when more went out than there are, with an override
+        return self.total - len(self.loans)
+
+    def entries(self):
+        return list(self.loans.values())
+
+    def borrowed(self, name):
+        return len(self.borrowers.get(name, ()))
+
+    def department(self, dept):
+        return self.departments[dept]
+
+    def checkout(self, entry):
+        key = next(self.keys)
+        self.loans[key] = entry
+        self.borrowers.setdefault(entry['borrower'], collections.deque()).append(key)
+        self.departments[entry['department']] += 1
+        return key
+
+    def oldest(self, name):
+        """
+The (key, entry) a return by `name` would close, or None.
+        """
+        queue = self.borrowers.get(name)
+        return (queue[0], self.loans[queue[0]]) if queue else None
+
+    def checkin(self, name):
+        """
+Closes the oldest loan to `name` and returns it as (key, entry), or None if
+they have nothing out.
+        """
+        found = self.oldest(name)
+        if found:
+            self.close(found[0], self.borrowers[name].popleft)
+        return found
+
+    def uncheckout(self):
+        """
+Takes back the most recent checkout, returning its key.
+        """
+        key = next(reversed(self.loans))
+        self.close(key, self.borrowers[self.loans[key]['borrower']].pop)
+        return key
+
+    def restore(self, key, entry):
+        """
+Puts back a loan closed by checkin, as the borrower's oldest again.
+        """
+        self.loans[key] = entry
+        self.borrowers.setdefault(entry['borrower'], collections.deque()).appendleft(key)
+        self.departments[entry['department']] += 1
+
+        # Only undoing a failed batch gets here, so re-sorting is affordable
+        self.loans = dict(sorted(self.loans.items()))
+
+    def close(self, key, dequeue):
+        entry = self.loans.pop(key)
+        dequeue()
+        if not self.borrowers[entry['borrower']]:
+            del self.borrowers[entry['borrower']]
+
+        self.departments[entry['department']] -= 1
+        if not self.departments[entry['department']]:
+            del self.departments[entry['department']]
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CHECKED_IN = 'CHECKED_IN'
+CHECKED_OUT = 'CHECKED_OUT'
+
+PERCENTILES = (50, 90, 99)
+
+
+class Columns(object):
+    """
+A few equal-length NumPy arrays that grow by doubling, so appending a row
+is cheap and every column can be handed to NumPy as a view.
+    """
+
+    def __init__(self, **dtypes):
+        self.n = 0
+        self.arrays = {name: numpy.empty(64, dtype) for name, dtype in dtypes.items()}
+
+    def append(self, **row):
+        if self.n == len(next(iter(self.arrays.values()))):
+            for name, array in self.arrays.items():
+                self.arrays[name] = numpy.resize(array, 2 * len(array))
+
+        for name, value in row.items():
+            self.arrays[name][self.n] = value
+        self.n += 1
+        return self.n - 1
+
+    def __getitem__(self, name):
+        return self.arrays[name][:self.n]
+
+    def set(self, name, row, value):
+        self.arrays[name][row] = value
+
+
+class Group(object):
+    """
+Running concurrency figures for one department (or the whole fleet) and one
+kind of item, as of the last change folded in.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.out = 0
+        self.peak = 0
+        self.since = None
+        self.over = 0.0
+        # bucket -> [peak out during it, out at its last change]
+        self.buckets = {}
+
+
+class Analytics(object):
+    """
+Usage statistics over the radio and accessory histories, which are kept as
+columnar arrays per kind of item: every loan as (start, end, department), and
+every change in what's out as (time, department, +1/-1).
+
+Events are added as they're applied. Concurrency figures (peaks, time over
+the department's limit, peak out per `bucket` seconds) are folded forward
+from where the last query left off, with only the new changes sorted and
+summed; if a change arrives earlier than ones already folded in, that kind
+is folded again from the start. Duration percentiles are computed over the
+loan arrays when asked for.
+    """
+
+    def __init__(self, limits=None, bucket=3600):
+        self.limits = limits if limits is not None else {}
+        self.bucket = bucket
+        self.load([])
+
+    def load(self, entries):
+        """
+Starts over from (time, op, id, entry) tuples, ideally in time order.
+        """
+        self.departments = {}
+        self.names = []
+        self.loans, self.changes = {}, {}
+        self.radios = {}
+        self.open_radios = {}
+        self.open_loans = {}
+        self.groups, self.folded, self.horizon = {}, {}, {}
+        self.kind('radio')
+
+        for entry in entries:
+            self.add(*entry)
+
+    def kind(self, kind):
+        # Accessory kinds are only known once they turn up
+        if kind not in self.loans:
+            self.loans[kind] = Columns(start='f8', end='f8', dept='i4')
+            self.changes[kind] = Columns(time='f8', dept='i4', delta='i1')
+            self.reset_groups(kind)
+
+    def reset_groups(self, kind):
+        self.groups[kind] = {}
+        self.folded[kind] = 0
+        self.horizon[kind] = float('-inf')
+
+    def department(self, name):
+        name = name or ''
+        if name not in self.departments:
+            self.departments[name] = len(self.names)
+            self.names.append(name)
+        return self.departments[name]
+
+    def open(self, kind, time, name):
+        self.kind(kind)
+        dept = self.department(name)
+        self.changes[kind].append(time=time, dept=dept, delta=1)
+        return self.loans[kind].append(start=time, end=numpy.nan, dept=dept)
+
+    def close(self, kind, time, row):
+        loans = self.loans[kind]
+        loans.set('end', row, time)
+        self.changes[kind].append(time=time, dept=loans['dept'][row], delta=-1)
+
+    def add(self, time, op, id, entry):
+        if op == 'radio':
+            self.radios.setdefault(id, 0)
+
+            row = self.open_radios.pop(id, None)
+            if row is not None:
+                self.close(op, time, row)
+
+            if entry['status'] == CHECKED_OUT:
+                self.open_radios[id] = self.open(op, time, entry['department'])
+                self.radios[id] += 1
+        else:
+            loans = self.open_loans.setdefault(op, {}).setdefault(entry['borrower'], collections.deque())
+            if entry['status'] == CHECKED_OUT:
+                loans.append(self.open(op, time, entry['department']))
+            elif loans:
+                self.close(op, time, loans.popleft())
+
+    def group(self, kind, dept):
+        groups = self.groups[kind]
+        if dept not in groups:
+            groups[dept] = Group(None if dept is None else self.limits.get(self.names[dept]))
+        return groups[dept]
+
+    def fold(self, kind):
+        changes = self.changes[kind]
+        start, end = self.folded[kind], changes.n
+        if start == end:
+            return
+
+        times = changes['time'][start:end]
+        if times.min() < self.horizon[kind]:
+            self.reset_groups(kind)
+            return self.fold(kind)
+
+        order = numpy.argsort(times, kind='stable')
+        times = times[order]
+        depts = changes['dept'][start:end][order]
+        deltas = changes['delta'][start:end][order].astype('i8')
+
+        self.fold_group(self.group(kind, None), times, deltas)
+        for dept in numpy.unique(depts):
+            mask = depts == dept
+            self.fold_group(self.group(kind, int(dept)), times[mask], deltas[mask])
+
+        self.folded[kind] = end
+        self.horizon[kind] = times[-1]
+
+    def fold_group(self, group, times, deltas):
+        counts = group.out + numpy.cumsum(deltas)
+
+        # Time spent over the limit, between the changes seen so far
+        if group.limit is not None:
+            before = numpy.concatenate(([group.out], counts[:-1]))
+            since = numpy.concatenate(([group.since if group.since is not None else times[0]], times[:-1]))
+            group.over += float(((times - since) * (before > group.limit)).sum())
+
+        # Peak out per bucket, counting what was already out as it began
+        buckets = (times // self.bucket).astype('i8')
+        firsts = numpy.flatnonzero(numpy.concatenate(([True], buckets[1:] != buckets[:-1])))
+        entering = numpy.concatenate(([group.out], counts))[firsts]
+        peaks = numpy.maximum(numpy.maximum.reduceat(counts, firsts), entering)
+        ends = counts[numpy.concatenate((firsts[1:], [len(counts)])) - 1]
+        for bucket, peak, out in zip(buckets[firsts].tolist(), peaks.tolist(), ends.tolist()):
+            group.buckets[bucket] = [max(group.buckets.get(bucket, [0])[0], peak), out]
+
+        group.out = int(counts[-1])
+        group.peak = max(group.peak, int(counts.max()))
+        group.since = float(times[-1])
+
+    def durations(self, kind, dept=None):
+        loans = self.loans[kind]
+        spans = loans['end'] - loans['start']
+        closed = ~numpy.isnan(spans)
+        if dept is not None:
+            closed &= loans['dept'] == dept
+
+        spans = spans[closed]
+        stats = {'count': int(len(spans)), 'mean': float(spans.mean()) if len(spans) else None}
+        values = numpy.percentile(spans, PERCENTILES).tolist() if len(spans) else [None] * len(PERCENTILES)
+        for p, value in zip(PERCENTILES, values):
+            stats['p{}'.format(p)] = value
+        return stats
+
+    def concurrency(self, group, now, first=None):
+        """
+Peak out per bucket from the first change (or bucket `first`) to now,
+carrying the count across buckets with no changes in them.
+        """
+        if first is None:
+            if not group.buckets:
+                return []
+            first = min(group.buckets)
+
+        series, out = [], 0
+        for bucket in range(first, int(now // self.bucket) + 1):
+            if bucket in group.buckets:
+                peak, out = group.buckets[bucket]
+            else:
+                peak = out
+            series.append([bucket * self.bucket, peak])
+        return series
+
+    def summary(self, group, now):
+        over = group.over
+        if group.limit is not None and group.out > group.limit and group.since is not None:
+            over += now - group.since
+
+        return {
+            'out': group.out,
+            'peak': group.peak,
+            'limit': group.limit,
+            'over_limit': over,
+        }
+
+    def stats(self, now, radios=None):
+        """
+Returns everything as plain JSON-able data. `radios` is the size of the
+fleet, if it includes radios never seen in an event.
+        """
+        result = {'bucket': self.bucket, 'kinds': list(self.loans)}
+        for kind in self.loans:
+            self.fold(kind)
+
+            total = self.group(kind, None)
+            # Every department's series lines up with the total's
+            first = min(total.buckets) if total.buckets else None
+            departments = {}
+            for dept, group in self.groups[kind].items():
+                if dept is not None:
+                    departments[self.names[dept]] = dict(self.summary(group, now), durations=self.durations(kind, dept),
+                                                         concurrency=self.concurrency(group, now, first))
+
+            result[kind] = dict(
+                self.summary(total, now),
+                durations=self.durations(kind),
+                departments=departments,
+                concurrency=self.concurrency(total, now),
+            )
+
+        fleet = max(radios or 0, len(self.radios))
+        result['fleet'] = {
+            'radios': fleet,
+            'never_used': fleet - sum(1 for uses in self.radios.values() if uses),
+            'idle_now': fleet - result['radio']['out'],
+            'min_idle': fleet - result['radio']['peak'],
+        }
+        return result
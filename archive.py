@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+import os
+import json
+import datetime
+import threading
+import collections
+import replay
+import storage
+import accessories
+
+# Segments read recently, kept parsed for paging through them
+CACHED_DAYS = 8
+
+
+def day_of(timestamp):
+    return datetime.date.fromtimestamp(timestamp).isoformat()
+
+
+def split_radio(history, before):
+    """
+Splits one radio's history at `before` into (archived, kept). The last entry
+before then is both archived and kept, since it's the radio's state as of
+then.
+    """
+    old = [evt for evt in history if evt['time'] < before]
+    return old, old[-1:] + [evt for evt in history if evt['time'] >= before]
+
+
+def split_accessories(history, before):
+    """
+The same for the accessory history: loans still out at `before` are kept, so
+returns after then have something to close.
+    """
+    old = [evt for evt in history if evt['time'] < before]
+    return old, [old[i] for i in accessories.open_loans(old)] + [evt for evt in history if evt['time'] >= before]
+
+
+class Archive(object):
+    """
+Events moved out of the live state, in one append-only file per day with a
+line of [type, radio id, entry] per event. index.json has, for each day, the
+span of times in its file, how many events and bytes it holds, and who and
+which departments and radios turn up in it, so a history query only opens
+the files that can have something for it.
+
+The index is replaced after the files are appended to, so it's what commits
+a write: anything past a file's indexed size was left by a crash, and is
+ignored and then overwritten. Every worker sharing the directory re-reads
+the index, under its lock, before writing or looking anything up.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, 'index.json')
+        self.shared = storage.SharedLock(self.path)
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Everything from before `until` has been written. `stat` identifies
+        # the index.json these were read from.
+        self.until = 0
+        self.days = {}
+        self.stat = None
+
+    def segment(self, day):
+        return os.path.join(self.directory, day + '.jsonl')
+
+    def refresh(self):
+        """
+Reads index.json again if it's been replaced since we last did. Call with
+both locks held.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+
+        stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if stat != self.stat:
+            with open(self.path) as f:
+                index = json.load(f)
+            self.until, self.days, self.stat = index.get('until', 0), index.get('days', {}), stat
+
+    def current(self):
+        """
+The index as it is now, as {day: description}.
+        """
+        # Threads share the flock, so they take turns at it
+        with self.lock, self.shared.hold(exclusive=False):
+            self.refresh()
+            return self.days
+
+    def write(self, records, until):
+        """
+Appends (type, id, entry) records, all from before `until`, to their days'
+files. Records from before a previous write's `until` are already here and
+skipped, whichever worker wrote them.
+        """
+        with self.lock, self.shared.hold():
+            self.refresh()
+
+            by_day = {}
+            for record in records:
+                if record[2]['time'] >= self.until:
+                    by_day.setdefault(day_of(record[2]['time']), []).append(record)
+
+            days = dict(self.days)
+            for day, found in sorted(by_day.items()):
+                found.sort(key=lambda record: record[2]['time'])
+                meta = dict(days.get(day) or {'first': found[0][2]['time'], 'count': 0, 'size': 0,
+                                              'borrowers': [], 'departments': [], 'radios': []})
+
+                with open(self.segment(day), 'ab') as f:
+                    f.truncate(meta['size'])
+                    f.write(''.join(json.dumps(record, separators=(',', ':')) + '\n'
+                                    for record in found).encode('utf-8'))
+                    f.flush()
+                    os.fsync(f.fileno())
+                    meta['size'] = f.tell()
+
+                meta['first'] = min(meta['first'], found[0][2]['time'])
+                meta['last'] = max(meta.get('last', found[-1][2]['time']), found[-1][2]['time'])
+                meta['count'] += len(found)
+                for key, values in (('borrowers', (entry['borrower'] for _, _, entry in found)),
+                                    ('departments', (entry['department'] for _, _, entry in found)),
+                                    ('radios', (id for _, id, _ in found))):
+                    meta[key] = sorted(set(meta[key]).union(value for value in values if value))
+                days[day] = meta
+
+            tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump({'until': max(self.until, until), 'days': days}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.path)
+
+            self.refresh()
+
+    def read(self, day, meta):
+        """
+Every record in one day's file as of its description `meta`, in time order.
+        """
+        size = meta['size']
+        cached = self.cache.get(day)
+        if cached and cached[0] == size:
+            return cached[1]
+
+        with open(self.segment(day), 'rb') as f:
+            records = [json.loads(line.decode('utf-8')) for line in f.read(size).splitlines()]
+
+        self.cache[day] = (size, records)
+        self.cache.move_to_end(day)
+        while len(self.cache) > CACHED_DAYS:
+            self.cache.popitem(last=False)
+        return records
+
+    def history(self, before, limit=None, since=None, borrower=None, department=None, radio=None):
+        """
+Up to `limit` archived (type, id, entry), newest first, from `since` up to
+but not including `before`, optionally only those of one borrower,
+department or radio.
+        """
+        wanted = [(key, value) for key, value in (('borrowers', borrower), ('departments', department),
+                                                  ('radios', radio)) if value is not None]
+
+        found = []
+        days = self.current()
+        for day in sorted(days, reverse=True):
+            meta = days[day]
+            if meta['first'] >= before or any(value not in meta[key] for key, value in wanted):
+                continue
+            if since is not None and meta['last'] < since:
+                break
+
+            for type, id, entry in reversed(self.read(day, meta)):
+                if entry['time'] >= before:
+                    continue
+                if since is not None and entry['time'] < since:
+                    break
+                if borrower is not None and entry['borrower'] != borrower:
+                    continue
+                if department is not None and entry['department'] != department:
+                    continue
+                if radio is not None and id != radio:
+                    continue
+
+                found.append((type, id, entry))
+                if limit is not None and len(found) >= limit:
+                    return found
+        return found
+
+    def state_at(self, timestamp):
+        """
+The state as of `timestamp`, as replay.Timeline.at returns it, rebuilt from
+every archived event up to then.
+        """
+        state = {'radios': {}, 'accessories': {}}
+        days = self.current()
+        for day in sorted(days):
+            if days[day]['first'] > timestamp:
+                break
+
+            for type, id, entry in self.read(day, days[day]):
+                if entry['time'] > timestamp:
+                    break
+                replay.step(state, type, id, entry)
+        return state
+
+    def borrowers(self):
+        return {name for meta in self.current().values() for name in meta['borrowers']}
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+import bisect
+
+
+def normalize(text):
+    return ' '.join(str(text).casefold().split())
+
+
+class PrefixIndex(object):
+    """
+The names borrowers have gone by, searchable by a prefix of the name, of any
+later word in it ("smi" finds "John Smith"), or of a badge number they've
+used. Every search term is kept in one sorted list of (term, name), so a
+search is a bisect followed by a walk over the terms that match.
+    """
+
+    def __init__(self):
+        self.load([])
+
+    def load(self, people):
+        """
+Starts over from (name, badge) pairs; badge may be None.
+        """
+        self.people = {}
+        for name, badge in people:
+            if name:
+                self.people.setdefault(name, set())
+                if badge is not None:
+                    self.people[name].add(badge)
+
+        terms = [(term, name) for name in self.people for term in self.name_terms(name)]
+        terms.extend((normalize(badge), name) for name, badges in self.people.items() for badge in badges)
+
+        # search() takes one reference to the list, so it finishes against
+        # whichever list was there when it started
+        self.terms = sorted(set(terms))
+
+    def name_terms(self, name):
+        words = normalize(name).split(' ')
+        return {' '.join(words[i:]) for i in range(len(words))}
+
+    def add(self, name, badge=None):
+        if not name:
+            return
+
+        if name not in self.people:
+            self.people[name] = set()
+            for term in self.name_terms(name):
+                self.insert((term, name))
+
+        if badge is not None and badge not in self.people[name]:
+            self.people[name].add(badge)
+            self.insert((normalize(badge), name))
+
+    def insert(self, term):
+        i = bisect.bisect_left(self.terms, term)
+        if i == len(self.terms) or self.terms[i] != term:
+            self.terms.insert(i, term)
+
+    def search(self, prefix, limit=10):
+        """
+Returns up to `limit` (name, badges) whose terms start with `prefix`, in
+order of the term matched.
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+
+        terms = self.terms
+        found = {}
+        for i in range(bisect.bisect_left(terms, (prefix,)), len(terms)):
+            term, name = terms[i]
+            if not term.startswith(prefix) or len(found) >= limit:
+                break
+            found.setdefault(name, None)
+
+        return [(name, sorted(self.people.get(name, ()), key=str)) for name in found]
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+import os
+import csv
+import ssl
+import json
+import time
+import queue
+import itertools
+import threading
+import collections
+import http.client
+import urllib.parse
+
+
+class LookupFailed(Exception):
+    """
+Uber couldn't be reached, or didn't answer within the timeout.
+    """
+
+
+class BadgeLookup(object):
+    """
+Resolves badge barcodes to (name, badge number) through Uber's JSON-RPC API.
+
+Answers are kept in an LRU cache for `ttl` seconds, and barcodes Uber doesn't
+recognize are remembered for `negative_ttl` so a bad scan isn't retried on
+every submit. Up to `pool_size` keep-alive connections are reused between
+lookups, and every request gives up after `timeout` seconds so a slow Uber
+never holds up the desk.
+    """
+
+    METHOD = 'barcode.lookup_attendee_from_barcode'
+
+    def __init__(self, uri, key_file=None, cert_file=None, timeout=2,
+                 ttl=3600, negative_ttl=60, cache_size=4096, pool_size=4):
+        url = urllib.parse.urlsplit(uri)
+        self.https = url.scheme == 'https'
+        self.host = url.netloc
+        self.path = url.path or '/'
+        self.timeout = timeout
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache_size = cache_size
+
+        self.context = None
+        if self.https:
+            self.context = ssl.create_default_context()
+            if cert_file:
+                self.context.load_cert_chain(cert_file, key_file)
+
+        self.pool = queue.LifoQueue(pool_size)
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+    def lookup(self, barcode):
+        """
+Returns (name, badge_num), or None if Uber doesn't know the barcode. Raises
+LookupFailed if Uber can't be asked.
+        """
+        now = time.time()
+        with self.lock:
+            if barcode in self.cache:
+                expires, found = self.cache[barcode]
+                if expires > now:
+                    self.cache.move_to_end(barcode)
+                    return found
+                del self.cache[barcode]
+
+        try:
+            res = self.call(self.METHOD, barcode_value=barcode)
+        except ValueError:
+            res = {'error': 'Unknown barcode'}
+
+        # An empty or partial result is no more use than an error
+        if 'error' in res or not res.get('full_name'):
+            found, ttl = None, self.negative_ttl
+        else:
+            found, ttl = (res['full_name'], res.get('badge_num')), self.ttl
+
+        with self.lock:
+            self.cache[barcode] = (now + ttl, found)
+            self.cache.move_to_end(barcode)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return found
+
+    def connection(self):
+        try:
+            return self.pool.get_nowait(), True
+        except queue.Empty:
+            pass
+
+        if self.https:
+            return http.client.HTTPSConnection(self.host, timeout=self.timeout, context=self.context), False
+        return http.client.HTTPConnection(self.host, timeout=self.timeout), False
+
+    def release(self, conn):
+        try:
+            self.pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def call(self, method, **params):
+        """
+Makes one JSON-RPC call and returns its result. An error answered by the
+server raises ValueError; anything stopping the call from being answered
+raises LookupFailed.
+        """
+        body = json.dumps({'jsonrpc': '2.0', 'method': method, 'params': params, 'id': next(self.ids)})
+
+        while True:
+            conn, reused = self.connection()
+            try:
+                conn.request('POST', self.path, body, {'Content-Type': 'application/json'})
+                res = json.loads(conn.getresponse().read().decode('utf-8'))
+                break
+            except (ConnectionResetError, BrokenPipeError, http.client.RemoteDisconnected) as e:
+                conn.close()
+                # The server dropped an idle connection; try again on a new one
+                if not reused:
+                    raise LookupFailed(str(e) or type(e).__name__)
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                conn.close()
+                raise LookupFailed(str(e) or type(e).__name__)
+
+        self.release(conn)
+
+        if res.get('error'):
+            raise ValueError(res['error'])
+
+        return res.get('result') or {}
+
+
+def badge_num(badge):
+    # CSV exports give badge numbers as text; Uber gives them as numbers
+    try:
+        return int(badge)
+    except (TypeError, ValueError):
+        return badge
+
+
+class Roster(object):
+    """
+An attendee export loaded into memory, so scans of registered attendees are
+resolved without asking Uber. The file is either a CSV with barcode, full_name
+and badge_num columns, or JSON mapping each barcode to {"full_name": ...,
+"badge_num": ...}. A background thread reloads it every `refresh` seconds
+after it changes, to pick up new registrations.
+    """
+
+    def __init__(self, path, refresh=300):
+        self.path = path
+        self.refresh = refresh
+        self.mtime = None
+        self.attendees = {}
+
+        self.reload()
+
+        if refresh:
+            self.thread = threading.Thread(target=self.run, name='roster-refresh')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def lookup(self, barcode):
+        return self.attendees.get(barcode)
+
+    def read(self):
+        with open(self.path, newline='') as f:
+            if self.path.endswith('.json'):
+                rows = json.load(f)
+                if isinstance(rows, dict):
+                    rows = (dict(row, barcode=barcode) for barcode, row in rows.items())
+            else:
+                rows = csv.DictReader(f)
+
+            return {row['barcode'].strip(): (row.get('full_name') or row.get('name'),
+                                             badge_num(row.get('badge_num') or row.get('badge')))
+                    for row in rows if row.get('barcode')}
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self.mtime:
+                return
+
+            # A file that fails to parse leaves the last good roster in place
+            self.attendees = self.read()
+            self.mtime = mtime
+            print('Loaded {} attendees from {}'.format(len(self.attendees), self.path))
+        except (OSError, ValueError, KeyError) as e:
+            print('Failed to load roster {}: {}'.format(self.path, e))
+
+    def run(self):
+        while True:
+            time.sleep(self.refresh)
+            self.reload()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# Imports an existing radios.json, plus any journal entries that haven't been
+# checkpointed yet, into an SQLite database:
+#
+#   ./migratedb.py radios.json radios.sqlite [radios.journal]
+#
+# Then point "db" in config.json at the new file.
+
+import os
+import sys
+import storage
+
+if len(sys.argv) not in (3, 4):
+    print("Usage: {} radios.json radios.sqlite [radios.journal]".format(sys.argv[0]))
+    sys.exit(1)
+
+src, dst = sys.argv[1], sys.argv[2]
+
+if not os.path.exists(src):
+    print("{} does not exist".format(src))
+    sys.exit(1)
+
+if len(sys.argv) == 4:
+    data, evts = storage.JournalStorage(src, sys.argv[3]).load()
+else:
+    data, evts = storage.JSONStorage(src).load()
+
+db = storage.SQLiteStorage(dst)
+db.save(data)
+db.record(evts, None)
+
+print("Imported {} radios, {} people and {} journal entries into {}".format(
+    len(data.get('radios', {})), len(data.get('people', {})), len(evts), dst))
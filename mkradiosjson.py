@@ -1,13 +1,56 @@
-import json
+#!/usr/bin/env python3
+# Writes a fresh radios.json holding just the given radios, for setting up a
+# new event:
+#
+#   ./mkradiosjson.py [--dry-run] radios.json 1-800 901-950 radios.csv
+#
+# Arguments ending in .csv are read like a /bulkadd upload (an 'id' column
+# plus any radio info); anything else is an id or a range.
 
-OUTPUT = {"headsets": 64, "audits": [], "radios": {}}
+import os
+import sys
+import itertools
+import storage
+import replay
+import provision
 
-radios = input("radio ids")
-for radio_id in radios.split(','):
-    id_str = str(int(radio_id.strip()))
+args = [arg for arg in sys.argv[1:] if arg != '--dry-run']
+dry_run = len(args) != len(sys.argv) - 1
 
-    OUTPUT['radios'][id_str] = {"history": [], "last_activity": 0, "checkout": {}}
-    
+if len(args) < 2:
+    print("Usage: {} [--dry-run] radios.json (ID|FIRST-LAST|radios.csv)...".format(sys.argv[0]))
+    sys.exit(1)
 
-with open('radios.json.new', 'w') as radiofile:
-    json.dump(OUTPUT, radiofile)
+dst, specs = args[0], args[1:]
+
+if os.path.exists(dst) and not dry_run:
+    print("{} already exists; use /bulkadd to add radios to it".format(dst))
+    sys.exit(1)
+
+
+def rows(spec):
+    if not spec.endswith('.csv'):
+        return provision.spec_rows(spec)
+
+    def read():
+        with open(spec, newline='') as f:
+            for line, id, info in provision.read_csv(f):
+                yield '{}:{}'.format(spec, line), id, info
+    return read()
+
+
+add, errors = provision.plan(itertools.chain(*(rows(spec) for spec in specs)), set())
+
+for line, message in errors:
+    print('{}{}'.format('{}: '.format(line) if line else '', message))
+
+if errors or not add:
+    print("Nothing was written")
+    sys.exit(1)
+
+print("{} {} radios: {}".format('Would add' if dry_run else 'Adding', len(add), provision.ranges(id for id, _ in add)))
+
+if not dry_run:
+    evts = (dict({'op': 'new_radio', 'id': id, 'time': 0, 'version': None}, **({'info': info} if info else {}))
+            for id, info in add)
+    storage.JSONStorage(dst).save(replay.replay(evts))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+import heapq
+import bisect
+import itertools
+
+
+class Overdue(object):
+    """
+Everything out right now, ordered by when it went out, overall and within
+each department. Each item is kept as (time, seq, kind, key), where kind is
+'radio', 'headset' or 'battery' and key is the radio id or, for accessories,
+whatever identifies the loan.
+
+Adding or removing an item is a bisect into two sorted lists. The N longest
+out are the front of a list. What's overdue is, for each department, the part
+of its list from before now minus the department's threshold.
+    """
+
+    def __init__(self, default=None, thresholds=None):
+        # Seconds out before an item is overdue; None never is
+        self.default = default
+        self.thresholds = thresholds if thresholds is not None else {}
+        self.clear()
+
+    def clear(self):
+        self.order = []
+        self.departments = {}
+        self.items = {}
+        self.seq = itertools.count()
+
+    def add(self, kind, key, entry):
+        self.remove(kind, key)
+
+        item = (entry['time'], next(self.seq), kind, key)
+        bisect.insort(self.order, item)
+        bisect.insort(self.departments.setdefault(entry['department'], []), item)
+        self.items[kind, key] = (item, entry)
+
+    def remove(self, kind, key):
+        found = self.items.pop((kind, key), None)
+        if not found:
+            return
+
+        item, entry = found
+        drop(self.order, item)
+
+        dept = self.departments[entry['department']]
+        drop(dept, item)
+        if not dept:
+            del self.departments[entry['department']]
+
+    def __len__(self):
+        return len(self.items)
+
+    def entries(self, items):
+        return [(kind, key, self.items[kind, key][1]) for _, _, kind, key in items]
+
+    def threshold(self, dept):
+        return self.thresholds.get(dept, self.default)
+
+    def oldest(self, n, dept=None):
+        """
+The `n` items out longest as (kind, key, entry), overall or in one department.
+        """
+        return self.entries((self.order if dept is None else self.departments.get(dept, []))[:n])
+
+    def overdue_items(self, now, dept):
+        threshold = self.threshold(dept)
+        if threshold is None:
+            return []
+
+        items = self.departments.get(dept, [])
+        return items[:bisect.bisect_left(items, (now - threshold,))]
+
+    def overdue(self, now, dept=None):
+        """
+Every item out longer than its department's threshold, longest out first.
+        """
+        if dept is not None:
+            return self.entries(self.overdue_items(now, dept))
+
+        return self.entries(heapq.merge(*(self.overdue_items(now, name) for name in self.departments)))
+
+    def summary(self, now):
+        """
+For each department with anything out: how much, how much of it is overdue,
+and when the longest-out item went out.
+        """
+        return {
+            dept: {
+                'out': len(items),
+                'overdue': len(self.overdue_items(now, dept)),
+                'threshold': self.threshold(dept),
+                'oldest': items[0][0],
+            } for dept, items in self.departments.items()
+        }
+
+
+def drop(items, item):
+    # Items are unique by seq, so the bisect lands on it exactly
+    del items[bisect.bisect_left(items, item)]
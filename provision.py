@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import re
+import csv
+import itertools
+
+RANGE_RE = re.compile(r'^(\d+)(?:-(\d+))?$')
+
+# Refuse ranges that are almost certainly typos ("1-80000" for "1-800")
+MAX_RANGE = 10000
+
+
+def expand(token):
+    """
+Turns "905" or "905-910" into radio ids. Raises ValueError on anything that
+isn't a positive id or an ascending range of them.
+    """
+    match = RANGE_RE.match(token)
+    if not match:
+        raise ValueError("Invalid radio ID {}".format(token))
+
+    start = int(match.group(1))
+    end = int(match.group(2) or start)
+    if start <= 0 or end < start or end - start >= MAX_RANGE:
+        raise ValueError("Invalid range {}".format(token))
+
+    return [str(id) for id in range(start, end + 1)]
+
+
+def tokens(spec):
+    return [token for token in re.split(r'[\s,]+', spec.strip()) if token]
+
+
+def spec_rows(spec):
+    """
+Streams (line, id, info) for ids and ranges typed as "1-800, 901 905-910".
+Tokens that can't be read come through with no id and the reason in place
+of the info, so they can be reported along with everything else.
+    """
+    for token in tokens(spec):
+        try:
+            ids = expand(token)
+        except ValueError as e:
+            yield None, None, str(e)
+            continue
+
+        for id in ids:
+            yield None, id, {}
+
+
+def read_csv(lines):
+    """
+Streams (line, id, info) out of a CSV with an 'id' column, which may hold a
+range, and any number of other columns that are kept on each radio as its
+info (serial number, model, channel plan...). Rows that can't be read come
+through as in spec_rows.
+    """
+    reader = csv.DictReader(lines)
+    if 'id' not in (reader.fieldnames or []):
+        raise ValueError("CSV needs an 'id' column")
+
+    for row in reader:
+        info = {key.strip(): value.strip() for key, value in row.items()
+                if key and key != 'id' and value and value.strip()}
+        try:
+            ids = [id for token in tokens(row['id'] or '') for id in expand(token)]
+        except ValueError as e:
+            yield reader.line_num, None, str(e)
+            continue
+
+        for id in ids:
+            yield reader.line_num, id, info
+
+
+def plan(rows, existing):
+    """
+Checks every (line, id, info) row before anything is added. Returns the
+radios to add as (id, info) and the problems found as (line, message); ids
+that already exist or appear twice are problems.
+    """
+    add, errors, seen = [], [], set()
+
+    try:
+        for line, id, info in rows:
+            if id is None:
+                errors.append((line, info))
+            elif id in existing:
+                errors.append((line, "Radio {} already exists".format(id)))
+            elif id in seen:
+                errors.append((line, "Radio {} is listed twice".format(id)))
+            else:
+                seen.add(id)
+                add.append((id, info))
+    except ValueError as e:
+        errors.append((None, str(e)))
+
+    return add, errors
+
+
+def ranges(ids):
+    """
+Summarizes ids as "1-800, 901" for reports.
+    """
+    numbers = sorted(int(id) for id in ids)
+    groups = itertools.groupby(enumerate(numbers), lambda pair: pair[1] - pair[0])
+
+    spans = []
+    for _, group in groups:
+        group = [number for _, number in group]
+        spans.append(str(group[0]) if len(group) == 1 else '{}-{}'.format(group[0], group[-1]))
+    return ', '.join(spans)
+
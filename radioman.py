@@ -1,10 +1,28 @@
 #!/usr/bin/env python3
 import re
 import json
+import math
 import time
+import zlib
+import codecs
+import bisect
+import functools
+import itertools
+import contextlib
+import collections
 import flask
 import jinja2
 import datetime
+import badges
+import replay
+import accessories
+import analytics
+import archive
+import autocomplete
+import overdue
+import provision
+import storage
+import threading
 from flask import request
 try:
     import urllib.parse as urllib
@@ -14,7 +32,11 @@ try:
     import html
 except ImportError:
     import cgi as html
-#from rpctools.jsonrpc import ServerProxy
+try:
+    import gevent
+    import gevent.monkey
+except ImportError:
+    gevent = None
 
 try:
     raise FileNotFoundError()
@@ -28,6 +50,23 @@ ENV = jinja2.Environment(loader=jinja2.FileSystemLoader('./templates'))
 
 CONFIG = {
     'db': 'radios.json',
+    'journal': None,
+    'checkpoint_interval': 1000,
+    'durability': 'sync',
+    'flush_interval': 500,
+    'flush_threshold': 100,
+    'render_cache_ttl': 60,
+    'change_feed_size': 10000,
+    'sse_keepalive': 15,
+    'history_page_size': 100,
+    'state_checkpoint_interval': 1000,
+    'stats_bucket': 3600,
+    'overdue_after': None,
+    'archive_dir': None,
+    'archive_after': 86400,
+    'archive_interval': 3600,
+    'shared': False,
+    'shared_poll_interval': 1000,
 }
 
 LIMITS = {}
@@ -40,6 +79,14 @@ TEMPLATE_PERSON = "person.jinja.html"
 TEMPLATE_DEPT = "dept.jinja.html"
 TEMPLATE_PRINTABLE = "print.jinja.html"
 TEMPLATE_BULK_ADD = "bulk.jinja.html"
+TEMPLATE_MACROS = "macros.jinja"
+TEMPLATE_ROW = "row.jinja.html"
+TEMPLATE_STATE = "state.jinja.html"
+TEMPLATE_STATS = "stats.jinja.html"
+TEMPLATE_OVERDUE = "overdue.jinja.html"
+
+# Stands in for the msg/err/warn banner in cached page bodies
+BANNER = '<!-- banner -->'
 
 BARCODE_RE = re.compile('^[A-Za-z0-9+=-]{6}$')
 
@@ -63,19 +110,114 @@ ALLOW_WRONG_PERSON = 'ALLOW_WRONG_PERSON'
 
 RADIOS = {}
 
+PEOPLE = {}
+
+# Incremented by every mutation; stored alongside the snapshot so journal
+# entries that were already checkpointed are skipped on replay.
+VERSION = 0
+
+STORAGE = None
+
+# Held while applying mutations, and by the storage layer while it
+# serializes the state from the background writer
+LOCK = threading.RLock()
+
+# Notified after every commit, to wake up /events subscribers
+FEED = threading.Condition(LOCK)
+
+# Cross-process lock and version stamp, when several workers share the database
+SHARED = None
+
+# Held around the status check and the commit of a checkout or return, so two
+# desks can't both hand out the same radio. Always taken before POOL_LOCK, and
+# in id order when taking several.
+RADIO_LOCKS = {}
+
+# Held around the limit checks and the commit of anything that counts against
+# a department's allocation or the accessory pools. Always taken before LOCK.
+POOL_LOCK = threading.RLock()
+
 AUDIT_LOG = []
 LAST_OPER = None
 
-HEADSET_TOTAL = 0
-HEADSETS = []
-HEADSET_HISTORY = []
+# Accessory pools by kind: headsets, batteries and any in config.json
+POOLS = {kind: accessories.Pool(kind) for kind, _ in accessories.BUILTIN}
+
+# Every accessory checkout and return, of every kind, in the order applied
+ACCESSORY_HISTORY = []
+
+# Radios currently out per department
+DEPT_TOTALS = {}
+
+# Per-borrower view of the state: the radio ids they have out right now, and
+# (type, radio id, event) for every event they're in
+BORROWERS = {}
+
+# Whether the indexes of the histories (the 'history' lists of BORROWERS and
+# DEPARTMENTS, TIMELINE, ANALYTICS and NAMES) have been built since the state
+# was loaded. Startup doesn't wait for them: index_history builds them in the
+# background, or when a page first needs them, and they're kept up to date
+# from then on.
+INDEXED = False
+
+# Bumped whenever the state is reloaded, so a build of the history indexes
+# from before then isn't swapped in
+LOADS = 0
+
+# Held by whichever thread is building the history indexes
+INDEXING = threading.Lock()
+
+# The same per department: radio ids out and every event filed under it
+DEPARTMENTS = {}
+
+# (int(id), id) for every radio, kept sorted for the index and printable pages
+RADIO_ORDER = []
+
+# (event, undo) for each event applied by the batch in progress, which
+# persists them all when it's done or reverts them if any item failed
+BATCH = None
+
+# Every radio and accessory event by time, for /state
+TIMELINE = replay.Timeline()
+
+# Usage statistics for /stats, when NumPy is installed
+ANALYTICS = analytics.Analytics(LIMITS) if analytics.numpy else None
+
+# ((VERSION, GENERATION, time bucket), statistics) for the last /stats request
+STATS = None
+
+# Radios and accessory loans out right now, by checkout time, for /overdue
+OVERDUE = overdue.Overdue()
+
+# Borrower names and badge numbers by prefix, for /autocomplete
+NAMES = autocomplete.PrefixIndex()
 
-BATTERY_TOTAL = 0
-BATTERIES = []
-BATTERY_HISTORY = []
+# Events from before ARCHIVED, moved out of the live histories, when
+# 'archive_dir' is set. The live state only keeps what of them it takes to
+# know what was out as of ARCHIVED: each radio's last entry from before then,
+# and the accessory loans still out then.
+ARCHIVE = None
+ARCHIVED = 0
+
+# Template name -> ((VERSION, GENERATION, time bucket), rendered body)
+RENDER_CACHE = {}
+
+# Bumped whenever a batch is reverted, since the versions it used get used
+# again for different events
+GENERATION = 0
+
+# The most recent events, with consecutive versions, for /changes
+CHANGES = collections.deque()
 
 UBER = None
 
+# Attendee export for resolving badge scans locally, when configured
+ROSTER = None
+
+# Background writers for radios.log and audits.log
+LOG = None
+AUDITS = None
+
 
 class RadioNotFound(Exception):
     pass
@@ -116,6 +258,11 @@ class DepartmentOverLimit(OverrideException):
 class WrongPerson(OverrideException):
     override = ALLOW_WRONG_PERSON
 
+class BatchFailed(Exception):
+    pass
+
+OVERRIDES = {cls.override for cls in OverrideException.__subclasses__()}
+
 def fmt_date(timestamp):
     return datetime.datetime.fromtimestamp(timestamp).strftime('%H:%M %a') if timestamp else '&hellip;'
 
@@ -147,6 +294,13 @@ Returns string representing "time since" e.g.
 
     return default
 
+def fmt_duration(seconds):
+    if seconds is None:
+        return '-'
+
+    minutes = int(seconds // 60)
+    return '{}h {:02d}m'.format(minutes // 60, minutes % 60) if minutes >= 60 else '{}m'.format(minutes)
+
 URLS = {
     'radio': '/radio/{}',
     'person': '/person/{}',
@@ -171,38 +325,574 @@ def link(key, type='radio', title=None):
 ENV.filters['fmt_date'] = fmt_date
 ENV.filters['full_date'] = full_date
 ENV.filters['rel_date'] = timesince
+ENV.filters['duration'] = fmt_duration
+ENV.filters['plural'] = accessories.plural
 ENV.filters['link'] = link
 ENV.filters['quote'] = urllib.quote
 ENV.filters['formquote'] = html.escape
 
 def load_db():
-    data = {}
-    radiofile = CONFIG['db']
+    data, evts = STORAGE.load()
+
+    global AUDIT_LOG, RADIOS, ACCESSORY_HISTORY, PEOPLE, VERSION, ARCHIVED
+
+    RADIOS = data.get('radios', {})
+
+    loans, ACCESSORY_HISTORY = accessories.read_db(data)
+    for kind in set(POOLS) | set(loans):
+        accessory_pool(kind).load(loans.get(kind, []))
+
+    PEOPLE = data.get('people', {})
+
+    AUDIT_LOG = data.get('audits', [])
+
+    VERSION = data.get('version', 0)
+
+    ARCHIVED = data.get('archived', 0)
+
+    rebuild_indexes()
+
+    for evt in evts:
+        apply_event(evt)
+
+def get_db():
+    return {'radios': RADIOS, 'accessories': {kind: pool.entries() for kind, pool in POOLS.items()}, 'audits': AUDIT_LOG, 'accessory_history': ACCESSORY_HISTORY, 'people': PEOPLE, 'version': VERSION, 'archived': ARCHIVED}
+
+def count_out(dept, delta):
+    DEPT_TOTALS[dept] = DEPT_TOTALS.get(dept, 0) + delta
+
+def borrower(name):
+    return BORROWERS.setdefault(name, {'radios': set(), 'history': []})
+
+def accessory_pool(kind):
+    # Kinds since dropped from config.json still turn up in old events
+    if kind not in POOLS:
+        POOLS[kind] = accessories.Pool(kind)
+    return POOLS[kind]
+
+def department(name):
+    return DEPARTMENTS.setdefault(name, {'radios': set(), 'history': []})
+
+def index_event(type, id, evt):
+    if evt['borrower']:
+        borrower(evt['borrower'])['history'].append((type, id, evt))
+    if evt['department']:
+        department(evt['department'])['history'].append((type, id, evt))
+
+def rebuild_indexes():
+    global INDEXED, LOADS
+
+    DEPT_TOTALS.clear()
+    BORROWERS.clear()
+    DEPARTMENTS.clear()
+    OVERDUE.clear()
+    INDEXED = False
+    LOADS += 1
+
+    RADIO_ORDER[:] = sorted((int(id), id) for id in RADIOS)
+
+    for id, radio in RADIOS.items():
+        if radio['status'] == CHECKED_OUT:
+            count_out(radio['checkout']['department'], 1)
+            borrower(radio['checkout']['borrower'])['radios'].add(id)
+            department(radio['checkout']['department'])['radios'].add(id)
+            OVERDUE.add('radio', id, radio['checkout'])
+
+    for kind, pool in POOLS.items():
+        pool.load(pool.entries())
+        for key, loan in pool.loans.items():
+            OVERDUE.add(kind, key, loan)
+
+def changes_since(since):
+    """
+Returns the events after version `since`, or None when the client has fallen
+out of the feed (or is ahead of it, if the database was replaced) and has to
+start over. Call with LOCK held.
+    """
+    if since == VERSION:
+        return []
+
+    if since < VERSION and CHANGES and CHANGES[0]['version'] <= since + 1:
+        return list(itertools.islice(CHANGES, since + 1 - CHANGES[0]['version'], None))
+
+    return None
+
+def history_snapshot():
+    """
+What build_indexes works from, copied so it can run without LOCK. Call with
+LOCK held.
+    """
+    return {
+        'loads': LOADS,
+        'version': VERSION,
+        'archived': ARCHIVED,
+        'radios': [(id, list(radio['history'])) for id, radio in RADIOS.items()],
+        'accessories': list(ACCESSORY_HISTORY),
+        'people': dict(PEOPLE),
+        'archived_borrowers': ARCHIVE.borrowers() if ARCHIVE else set(),
+    }
+
+def timeline_entries(radios, accessory_history):
+    return itertools.chain(
+        ((evt['time'], 'radio', id, evt) for id, history in radios for evt in history),
+        ((evt['time'], evt['type'], None, evt) for evt in accessory_history),
+    )
+
+def build_indexes(snapshot):
+    """
+Returns the history indexes for a snapshot, as ({borrower: history},
+{department: history}, timeline, analytics, names). Everything it needs is
+in the snapshot, so it can run off_hub().
+    """
+    borrowers, departments = {}, {}
+    evts = itertools.chain(
+        (('radio', id, evt) for id, history in snapshot['radios'] for evt in history),
+        ((evt['type'], None, evt) for evt in snapshot['accessories']),
+    )
+    for type, id, evt in evts:
+        # What's kept from before ARCHIVED is looked up in the archive
+        if evt['time'] >= snapshot['archived']:
+            if evt['borrower']:
+                borrowers.setdefault(evt['borrower'], []).append((type, id, evt))
+            if evt['department']:
+                departments.setdefault(evt['department'], []).append((type, id, evt))
+
+    # Live events arrive in time order, but this files them type by type
+    for index in (borrowers, departments):
+        for history in index.values():
+            history.sort(key=lambda entry: entry[2]['time'])
+
+    timeline = replay.Timeline(TIMELINE.interval)
+    timeline.load(timeline_entries(snapshot['radios'], snapshot['accessories']))
+
+    stats = None
+    if ANALYTICS:
+        stats = analytics.Analytics(LIMITS, ANALYTICS.bucket)
+        stats.load((at,) + evt for at, evt in zip(timeline.times, timeline.events))
+
+    names = autocomplete.PrefixIndex()
+    names.load(known_names(borrowers, snapshot['people'], snapshot['archived_borrowers']))
+
+    return borrowers, departments, timeline, stats, names
+
+def install_indexes(built, snapshot):
+    """
+Swaps in indexes built from `snapshot`, then files what's been committed
+since from CHANGES. Returns False, leaving things as they were, if that's
+not possible because the state was reloaded in the meantime. Call with LOCK
+held.
+    """
+    global TIMELINE, ANALYTICS, NAMES, INDEXED
+
+    evts = changes_since(snapshot['version'])
+    if LOADS != snapshot['loads'] or evts is None:
+        return False
+
+    borrowers, departments, TIMELINE, ANALYTICS, NAMES = built
+    for name, history in borrowers.items():
+        borrower(name)['history'] = history
+    for name, history in departments.items():
+        department(name)['history'] = history
+    INDEXED = True
+
+    if snapshot['archived'] != ARCHIVED:
+        trim_indexes(ARCHIVED)
+
+    for evt in evts:
+        op = evt['op']
+        if op == 'radio':
+            file_event('radio', evt['id'], evt['checkout'])
+        elif 'entry' in evt:
+            file_event(op, None, evt['entry'])
+        elif op == 'person':
+            NAMES.add(evt['name'], evt['id'])
+        elif op == 'new_radio':
+            track(evt['time'], 'radio', evt['id'], RADIOS[evt['id']]['checkout'])
+    return True
+
+def index_history():
+    """
+Builds the history indexes, if they haven't been since the state was
+loaded. That's done from a copy of the histories without holding LOCK, so
+checkouts carry on meanwhile, and only done again holding it if the state
+was reloaded before the build could be swapped in. Never call it with LOCK
+held, since a build under way needs LOCK to finish.
+    """
+    if INDEXED:
+        return
+
+    with INDEXING:
+        if INDEXED:
+            return
+
+        with LOCK:
+            snapshot = history_snapshot()
+
+        built = off_hub(build_indexes, snapshot)
+
+        with LOCK:
+            if not install_indexes(built, snapshot):
+                snapshot = history_snapshot()
+                install_indexes(off_hub(build_indexes, snapshot), snapshot)
+
+def off_hub(f, *args):
+    """
+Calls `f`, a long bit of number crunching that takes no locks, where it
+won't hold up other requests. In a gevent worker threads are greenlets, and
+one busy greenlet stops the rest, so that's in gevent's pool of real threads.
+    """
+    if gevent and gevent.monkey.is_module_patched('threading'):
+        return gevent.get_hub().threadpool.apply(f, args)
+    return f(*args)
+
+def indexer():
+    try:
+        index_history()
+    except Exception as e:
+        print('Failed to index the history, will retry when it\'s needed: {}'.format(e))
+
+def reload_analytics():
+    if ANALYTICS:
+        ANALYTICS.load((at,) + evt for at, evt in zip(TIMELINE.times, TIMELINE.events))
+
+def known_names(borrowers, people, archived):
+    return itertools.chain(
+        ((name, evt.get('badge')) for name, history in borrowers.items() for _, _, evt in history),
+        ((name, id) for id, name in people.items()),
+        ((name, None) for name in archived),
+    )
+
+def reload_names():
+    NAMES.load(known_names({name: record['history'] for name, record in BORROWERS.items()}, PEOPLE,
+                           ARCHIVE.borrowers() if ARCHIVE else ()))
+
+def track(at, op, id, entry):
+    TIMELINE.add(at, op, id, entry)
+    if ANALYTICS:
+        ANALYTICS.add(at, op, id, entry)
+
+def file_event(type, id, evt):
+    # Anything applied before the indexes are built gets picked up by the build
+    if INDEXED:
+        index_event(type, id, evt)
+        track(evt['time'], type, id, evt)
+        NAMES.add(evt['borrower'], evt.get('badge'))
+
+def apply_event(evt):
+    global VERSION
+
+    op = evt['op']
+    if op == 'radio':
+        id, checkout = evt['id'], evt['checkout']
+        radio = RADIOS[id]
+        if radio['status'] == CHECKED_OUT:
+            count_out(radio['checkout']['department'], -1)
+            borrower(radio['checkout']['borrower'])['radios'].discard(id)
+            department(radio['checkout']['department'])['radios'].discard(id)
+            OVERDUE.remove('radio', id)
+        if checkout['status'] == CHECKED_OUT:
+            count_out(checkout['department'], 1)
+            borrower(checkout['borrower'])['radios'].add(id)
+            department(checkout['department'])['radios'].add(id)
+            OVERDUE.add('radio', id, checkout)
+
+        radio['status'] = checkout['status']
+        radio['last_activity'] = checkout['time']
+        radio['checkout'] = checkout
+        radio['history'].append(checkout)
+        file_event('radio', id, checkout)
+    elif 'entry' in evt:
+        entry = evt['entry']
+        # Journaled before entries said what they were
+        entry.setdefault('type', op)
+
+        pool = accessory_pool(op)
+        if entry['status'] == CHECKED_OUT:
+            OVERDUE.add(op, pool.checkout(entry), entry)
+        else:
+            # Returns always close the borrower's oldest loan
+            closed = pool.checkin(entry['borrower'])
+            if closed:
+                OVERDUE.remove(op, closed[0])
+        ACCESSORY_HISTORY.append(entry)
+        file_event(op, None, entry)
+    elif op == 'person':
+        PEOPLE[evt['id']] = evt['name']
+        if INDEXED:
+            NAMES.add(evt['name'], evt['id'])
+    elif op == 'new_radio':
+        RADIOS[evt['id']] = get_blank_radio()
+        if evt.get('info'):
+            RADIOS[evt['id']]['info'] = evt['info']
+        bisect.insort(RADIO_ORDER, (int(evt['id']), evt['id']))
+        if INDEXED:
+            track(evt['time'], 'radio', evt['id'], RADIOS[evt['id']]['checkout'])
+    elif op == 'archive':
+        trim_history(evt['time'])
+
+    CHANGES.append(evt)
+    VERSION = evt['version']
+
+def trim_history(before):
+    """
+Drops what archive_history wrote out from the live histories.
+    """
+    global ACCESSORY_HISTORY, ARCHIVED
+
+    for radio in RADIOS.values():
+        radio['history'] = archive.split_radio(radio['history'], before)[1]
+    ACCESSORY_HISTORY = archive.split_accessories(ACCESSORY_HISTORY, before)[1]
+
+    ARCHIVED = before
+    if INDEXED:
+        trim_indexes(before)
+
+def trim_indexes(before):
+    """
+Drops what trim_history did from the history indexes, leaving them as
+build_indexes would have built them from the trimmed histories. Call with
+LOCK held.
+    """
+    for record in itertools.chain(BORROWERS.values(), DEPARTMENTS.values()):
+        record['history'] = [item for item in record['history'] if item[2]['time'] >= before]
+
+    TIMELINE.load(timeline_entries(((id, radio['history']) for id, radio in RADIOS.items()), ACCESSORY_HISTORY))
+    reload_analytics()
+
+def archive_history(now):
+    """
+Moves the events from more than 'archive_after' seconds before `now` into
+the archive, and commits an 'archive' event to trim them from the state
+everywhere. Call with the state held exclusively, outside a batch.
+    """
+    before = now - CONFIG.get('archive_after', 86400)
+    if not ARCHIVE or before <= ARCHIVED:
+        return
+
+    # Entries kept from the last time around were written out then
+    records = [('radio', id, evt) for id, radio in RADIOS.items()
+               for evt in archive.split_radio(radio['history'], before)[0] if evt['time'] >= ARCHIVED]
+    records.extend((evt['type'], None, evt) for evt in archive.split_accessories(ACCESSORY_HISTORY, before)[0]
+                   if evt['time'] >= ARCHIVED)
+
+    # Committing would rewrite the database for nothing
+    if not records:
+        return
+
+    ARCHIVE.write(records, before)
+    commit({'op': 'archive', 'time': before})
+
+def archiver(interval):
+    # The first pass is made here rather than in configure(), so starting
+    # up doesn't wait on it
+    while True:
+        try:
+            with shared_state(exclusive=True):
+                archive_history(time.time())
+        except Exception as e:
+            print('Failed to archive history, will retry: {}'.format(e))
+        time.sleep(interval)
+
+def undo_for(evt):
+    """
+Captures what revert_event will need to undo `evt`, before it's applied.
+    """
+    op = evt['op']
+    if op == 'radio':
+        radio = RADIOS[evt['id']]
+        return radio['status'], radio['last_activity'], radio['checkout']
+    elif 'entry' in evt:
+        entry = evt['entry']
+        if entry['status'] == CHECKED_IN:
+            return accessory_pool(op).oldest(entry['borrower'])
+    elif op == 'person':
+        return PEOPLE.get(evt['id'])
+
+def unfile_event(evt):
+    if not INDEXED:
+        return
+
+    if evt['borrower']:
+        borrower(evt['borrower'])['history'].pop()
+    if evt['department']:
+        department(evt['department'])['history'].pop()
+    TIMELINE.remove(evt['time'], evt)
+
+def revert_event(evt, undo):
+    """
+Undoes apply_event for the most recently applied event.
+    """
+    global VERSION
+
+    op = evt['op']
+    if op == 'radio':
+        id = evt['id']
+        radio = RADIOS[id]
+        checkout = radio['checkout']
+        if checkout['status'] == CHECKED_OUT:
+            count_out(checkout['department'], -1)
+            borrower(checkout['borrower'])['radios'].discard(id)
+            department(checkout['department'])['radios'].discard(id)
+            OVERDUE.remove('radio', id)
+
+        radio['status'], radio['last_activity'], radio['checkout'] = undo
+        if radio['status'] == CHECKED_OUT:
+            count_out(radio['checkout']['department'], 1)
+            borrower(radio['checkout']['borrower'])['radios'].add(id)
+            department(radio['checkout']['department'])['radios'].add(id)
+            OVERDUE.add('radio', id, radio['checkout'])
+
+        radio['history'].pop()
+        unfile_event(checkout)
+    elif 'entry' in evt:
+        entry = evt['entry']
+        pool = accessory_pool(op)
+        if entry['status'] == CHECKED_OUT:
+            OVERDUE.remove(op, pool.uncheckout())
+        elif undo:
+            pool.restore(*undo)
+            OVERDUE.add(op, *undo)
+        ACCESSORY_HISTORY.pop()
+        unfile_event(entry)
+    elif op == 'person':
+        if undo is None:
+            PEOPLE.pop(evt['id'], None)
+        else:
+            PEOPLE[evt['id']] = undo
+    elif op == 'new_radio':
+        checkout = RADIOS.pop(evt['id'])['checkout']
+        if INDEXED:
+            TIMELINE.remove(evt['time'], checkout)
+        RADIO_ORDER.remove((int(evt['id']), evt['id']))
+
+    CHANGES.pop()
+    VERSION = evt['version'] - 1
+
+def persist(evts):
+    for evt in evts:
+        log(*replay.event_row(evt))
+
+    STORAGE.record(evts, get_db)
+    if SHARED:
+        SHARED.write_stamp(VERSION)
+    FEED.notify_all()
+
+def commit(*evts):
+    with LOCK:
+        for evt in evts:
+            evt['version'] = VERSION + 1
+            if BATCH is not None:
+                BATCH.append((evt, undo_for(evt)))
+            apply_event(evt)
+
+        if BATCH is None:
+            persist(evts)
+
+@contextlib.contextmanager
+def batch():
+    """
+Makes everything committed inside it atomic: it's all persisted at once at
+the end, or reverted if the block raises. Callers hold LOCK throughout.
+    """
+    global BATCH, GENERATION
+    BATCH = []
     try:
-        with open(radiofile) as f:
-            data = json.load(f)
-        global HEADSETS, AUDIT_LOG, RADIOS, HEADSET_HISTORY, BATTERY_HISTORY, BATTERIES, PEOPLE
+        yield
+    except:
+        for evt, undo in reversed(BATCH):
+            revert_event(evt, undo)
+        GENERATION += 1
+        if INDEXED:
+            reload_analytics()
+            reload_names()
+        raise
+    else:
+        persist([evt for evt, _ in BATCH])
+    finally:
+        BATCH = None
+
+def sync():
+    """
+Catches up with writes made by other worker processes: replays just their
+new events where the backend can find them, else reloads everything. Call
+with SHARED held.
+    """
+    stamp = SHARED.read_stamp()
+    if stamp is None or stamp == VERSION:
+        return
 
-        RADIOS = data.get('radios', {})
+    for evt in STORAGE.catch_up(VERSION):
+        apply_event(evt)
 
-        HEADSETS = data.get('headsets', [])
-        if isinstance(HEADSETS, int):
-            HEADSETS = []
-        BATTERIES = data.get('batteries', [])
+    if VERSION != stamp:
+        load_db()
+        # The feed would have a gap in it, so clients have to refresh
+        # everything
+        CHANGES.clear()
 
-        HEADSET_HISTORY = data.get('headset_history', [])
-        BATTERY_HISTORY = data.get('battery_history', [])
+@contextlib.contextmanager
+def shared_state(exclusive=False):
+    """
+Holds LOCK and, in shared mode, the cross-process lock, with the in-memory
+state brought up to date with every other worker.
+    """
+    with LOCK:
+        if not SHARED:
+            yield
+            return
+
+        with SHARED.hold(exclusive):
+            sync()
+            yield
+
+def poller(interval):
+    """
+Catches up with other workers' writes as they're made, rather than at the
+next request, and wakes the event streams for them.
+    """
+    while True:
+        time.sleep(interval)
+        # Reading the stamp is cheap; only take the locks when it's moved on
+        if SHARED.read_stamp() in (None, VERSION):
+            continue
 
-        PEOPLE = data.get('people', {})
+        try:
+            with shared_state():
+                FEED.notify_all()
+        except Exception as e:
+            print('Failed to catch up with other workers, will retry: {}'.format(e))
 
-        AUDIT_LOG = data.get('audits', [])
-    except FileNotFoundError:
-        with open(radiofile, 'w') as f:
-            json.dump({}, f)
+@contextlib.contextmanager
+def exclusive_state():
+    """
+Holds the cross-process lock in shared mode, so checks and the writes they
+lead to can't interleave with another worker's. Only in shared mode, since
+otherwise the radio and pool locks are enough. Don't make network calls
+while holding it: every worker waits on it.
+    """
+    if not SHARED:
+        yield
+        return
 
-def save_db():
-    with open(CONFIG['db'], 'w') as f:
-        json.dump({'radios': RADIOS, 'headsets': HEADSETS, 'audits': AUDIT_LOG, 'batteries': BATTERIES, 'headset_history': HEADSET_HISTORY, 'battery_history': BATTERY_HISTORY, 'people': PEOPLE}, f)
+    with shared_state(exclusive=True):
+        yield
+
+def exclusive(f):
+    """
+Runs a whole mutating request in exclusive_state().
+    """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        with exclusive_state():
+            return f(*args, **kwargs)
+    return wrapper
+
+def radio_lock(id):
+    if id not in RADIOS:
+        raise RadioNotFound("Radio does not exist")
+
+    # setdefault is atomic, so two threads can't end up with different locks
+    return RADIO_LOCKS.setdefault(id, threading.RLock())
 
 def get_blank_radio():
     return {
@@ -226,23 +916,70 @@ def get_blank_radio():
     }
 
 def configure(f):
-    global CONFIG, RADIOS, HEADSET_TOTAL, BATTERY_TOTAL
+    global CONFIG, RADIOS, STORAGE, CHANGES, SHARED, LOG, AUDITS, ARCHIVE
+    started = time.time()
     with open(f) as conf:
         CONFIG.update(json.load(conf))
 
-    load_db()
+    CHANGES = collections.deque(maxlen=CONFIG.get('change_feed_size', 10000))
+    TIMELINE.interval = CONFIG.get('state_checkpoint_interval', 1000)
+    if ANALYTICS:
+        ANALYTICS.bucket = CONFIG.get('stats_bucket', 3600)
+
+    # Before anything is committed, since every event is logged
+    opts = {
+        'interval': CONFIG.get('log_flush_interval', 1000) / 1000.0,
+        'max_bytes': CONFIG.get('log_max_bytes', 0),
+        'daily': CONFIG.get('log_rotate_daily', False),
+    }
+    LOG = storage.LogWriter(CONFIG.get('log', 'radios.log'), **opts)
+    AUDITS = storage.LogWriter(CONFIG.get('audit_log', 'audits.log'), **opts)
+
+    STORAGE = storage.get_storage(CONFIG, lock=LOCK)
+
+    if CONFIG.get('shared'):
+        SHARED = storage.SharedLock(CONFIG['db'])
+
+    if CONFIG.get('archive_dir'):
+        ARCHIVE = archive.Archive(CONFIG['archive_dir'])
+
+    with SHARED.hold() if SHARED else LOCK:
+        loading = time.time()
+        load_db()
+        loaded = time.time()
+
+        new_radios = [str(radio) for radio in CONFIG.get('radios', []) if str(radio) not in RADIOS]
+        if new_radios:
+            commit(*({'op': 'new_radio', 'id': radio, 'time': 0} for radio in new_radios))
 
-    for radio in CONFIG.get('radios', []):
-        if str(radio) not in RADIOS:
-            RADIOS[radio] = get_blank_radio()
+        if SHARED:
+            SHARED.write_stamp(VERSION)
 
+    if SHARED:
+        thread = threading.Thread(target=poller, args=(CONFIG.get('shared_poll_interval', 1000) / 1000.0,), name='poller')
+        thread.daemon = True
+        thread.start()
+
+    if ARCHIVE:
+        thread = threading.Thread(target=archiver, args=(CONFIG.get('archive_interval', 3600),), name='archiver')
+        thread.daemon = True
+        thread.start()
+
+    # Have the history indexes ready before a page asks for them
+    thread = threading.Thread(target=indexer, name='indexer')
+    thread.daemon = True
+    thread.start()
+
+    OVERDUE.default = CONFIG.get('overdue_after')
     for name, dept in CONFIG.get('departments', {}).items():
         LIMITS[name] = dept.get('limit', UNLIMITED)
+        if 'overdue_after' in dept:
+            OVERDUE.thresholds[name] = dept['overdue_after']
 
-    HEADSET_TOTAL = CONFIG.get('headsets', 0)
-    BATTERY_TOTAL = CONFIG.get('batteries', 0)
-
-    save_db()
+    for kind, key in accessories.BUILTIN:
+        POOLS[kind].total = CONFIG.get(key, 0)
+    for kind, total in CONFIG.get('accessories', {}).items():
+        accessory_pool(kind).total = total
 
     global UBER
     if 'uber' in CONFIG:
@@ -251,56 +988,53 @@ def configure(f):
         cert = uber.get('cert', './client.crt')
         uri = uber.get('uri', 'https://magfest.uber.org/jsonrpc')
 
+        opts = {
+            'timeout': uber.get('timeout', 2),
+            'ttl': uber.get('cache_ttl', 3600),
+            'negative_ttl': uber.get('negative_ttl', 60),
+        }
+
         if uber.get('auth', False):
-            UBER = ServerProxy(uri=uri,
-                               key_file=key,
-                               cert_file=cert)
+            UBER = badges.BadgeLookup(uri,
+                                      key_file=key,
+                                      cert_file=cert,
+                                      **opts)
         else:
-            UBER = ServerProxy(uri)
+            UBER = badges.BadgeLookup(uri, **opts)
     else:
         print('Security not configured, probably won\'t be able to use barcodes')
 
+    global ROSTER
+    if CONFIG.get('roster'):
+        ROSTER = badges.Roster(CONFIG['roster'], refresh=CONFIG.get('roster_refresh', 300))
+
+    print('Started in {:.3f}s: loaded {} radios at version {} from {} in {:.3f}s, using {}'.format(
+        time.time() - started, len(RADIOS), VERSION, CONFIG['db'], loaded - loading,
+        'orjson' if storage.orjson else 'json'))
+
 def log(*fields):
-    logfile = CONFIG.get('log', 'radios.log')
-    with open(logfile, 'a+') as f:
-        f.write(','.join((str(f) for f in fields)) + '\n')
+    LOG.write(*fields)
 
 def log_audit(*fields):
-    logfile = CONFIG.get('audit_log', 'audits.log')
-    with open(logfile, 'a+') as f:
-        f.write(','.join((str(f) for f in fields)) + '\n')
+    AUDITS.write(*fields)
 
 def department_total(dept):
-    radio_count = 0
-    headset_count = 0
-    battery_count = 0
+    return DEPT_TOTALS.get(dept, 0)
 
-    for radio in RADIOS.values():
-        if radio['status'] == CHECKED_OUT and \
-           radio['checkout']['department'] == dept:
-            radio_count += 1
+def department_accessories(dept):
+    return {kind: pool.department(dept) for kind, pool in POOLS.items()}
 
-    for headset in HEADSETS:
-        if headset['status'] == CHECKED_OUT and \
-           headset['department'] == dept:
-            headset_count += 1
+def borrower_total(name):
+    return len(BORROWERS[name]['radios']) if name in BORROWERS else 0
 
-    for battery in BATTERIES:
-        if battery['status'] == CHECKED_OUT and \
-           battery['department'] == dept:
-            battery_count += 1
-    return radio_count, headset_count, battery_count
+def borrower_accessories(name):
+    return {kind: pool.borrowed(name) for kind, pool in POOLS.items()}
 
 
 def filter_items(model, **kwargs):
     if model == "radios":
         return {id: radio for radio in RADIOS if all((attr in radio['checkout'] and radio['checkout'][attr] == val for attr, val in kwargs.items()))}
-    if model == "headsets":
-        target = HEADSETS
-    elif model == "batteries":
-        target = BATTERIES
-    else:
-        target = []
+    target = next((pool.entries() for pool in POOLS.values() if pool.plural == model), [])
     return [item for item in target if all((attr in item and item[attr] == val for attr, val in kwargs.items()))]
 
 
@@ -316,191 +1050,160 @@ def filter_batteries(**kwargs):
     return filter_items("batteries", **kwargs)
 
 
-def checkout_battery(dept, name=None, badge=None, barcode=None, overrides=[]):
-    if dept in LIMITS and LIMITS[dept] != UNLIMITED and department_total(dept)[2] >= LIMITS[dept]:
-        raise DepartmentOverLimit("{} has already checked out too many batteries".format(dept))
+def checkout_accessory(kind, dept, name=None, badge=None, barcode=None, overrides=[ALLOW_NEGATIVE_HEADSETS]):
+    pool = POOLS[kind]
+    with POOL_LOCK:
+        if pool.available() <= 0 and \
+           ALLOW_NEGATIVE_HEADSETS not in overrides:
+            raise HeadsetUnavailable("No {} left".format(pool.plural))
+
+        if dept in LIMITS and LIMITS[dept] != UNLIMITED and pool.department(dept) >= LIMITS[dept] and \
+           ALLOW_DEPARTMENT_OVERDRAFT not in overrides:
+            raise DepartmentOverLimit("{} has already checked out too many {}".format(dept, pool.plural))
+
+        entry = {
+            "type": kind,
+            "department": dept,
+            "borrower": name,
+            "time": time.time(),
+            "status": CHECKED_OUT,
+            "badge": badge
+        }
+        commit({'op': kind, 'entry': entry})
 
-    entry = {
-        "department": dept,
-        "borrower": name,
-        "time": time.time(),
-        "status": CHECKED_OUT,
-        "badge": badge
-    }
-    BATTERIES.append(entry)
 
-    BATTERY_HISTORY.append(entry)
-    save_db()
+def checkout_battery(dept, name=None, badge=None, barcode=None, overrides=[ALLOW_NEGATIVE_HEADSETS]):
+    checkout_accessory('battery', dept, name=name, badge=badge, barcode=barcode, overrides=overrides)
 
 
 def checkout_headset(dept, name=None, badge=None, barcode=None, overrides=[ALLOW_NEGATIVE_HEADSETS]):
-    if len(HEADSETS) >= HEADSET_TOTAL and \
-       ALLOW_NEGATIVE_HEADSETS not in overrides:
-        raise HeadsetUnavailable("No headsets left")
-
-    if dept in LIMITS and LIMITS[dept] != UNLIMITED and department_total(dept)[1] >= LIMITS[dept]:
-        raise DepartmentOverLimit("{} has already checked out too many headsets".format(dept))
-
-    entry = {
-        "department": dept,
-        "borrower": name,
-        "time": time.time(),
-        "status": CHECKED_OUT,
-        "badge": badge
-    }
-    HEADSETS.append(entry)
-
-    HEADSET_HISTORY.append(entry)
-    save_db()
+    checkout_accessory('headset', dept, name=name, badge=badge, barcode=barcode, overrides=overrides)
 
 
 def checkout_radio(id, dept, name=None, badge=None, barcode=None, headset=False, overrides=[]):
     try:
-        radio = RADIOS[id]
+        with radio_lock(id), POOL_LOCK:
+            radio = RADIOS[id]
 
-        if radio['status'] == LOCKED:
-            raise RadioLocked("Radio is locked")
+            if radio['status'] == LOCKED:
+                raise RadioLocked("Radio is locked")
 
-        if radio['status'] == CHECKED_OUT and \
-           ALLOW_DOUBLE_CHECKOUT not in overrides:
-            raise RadioUnavailable("Already checked out")
+            if radio['status'] == CHECKED_OUT and \
+               ALLOW_DOUBLE_CHECKOUT not in overrides:
+                raise RadioUnavailable("Already checked out")
 
 
-        if dept in LIMITS and \
-           (LIMITS[dept] != UNLIMITED and
-            department_total(dept)[0] >= LIMITS[dept]) and \
-            ALLOW_DEPARTMENT_OVERDRAFT not in overrides:
-            raise DepartmentOverLimit("Department has already received all allocated radios ({})".format(LIMITS[dept]))
+            if dept in LIMITS and \
+               (LIMITS[dept] != UNLIMITED and
+                department_total(dept) >= LIMITS[dept]) and \
+                ALLOW_DEPARTMENT_OVERDRAFT not in overrides:
+                raise DepartmentOverLimit("Department has already received all allocated radios ({})".format(LIMITS[dept]))
+
+            if headset:
+                checkout_headset(dept, name=name, badge=badge, barcode=barcode, overrides=overrides + [ALLOW_NEGATIVE_HEADSETS])
+
+            commit({'op': 'radio', 'id': id, 'checkout': {
+                'status': CHECKED_OUT,
+                'time': time.time(),
+                'borrower': name,
+                'department': dept,
+                'badge': badge,
+                'barcode': barcode,
+                'headset': headset,
+            }})
+    except IndexError:
+        raise RadioNotFound("Radio does not exist")
 
-        if headset:
-            checkout_headset(dept, name=name, badge=badge, barcode=barcode, overrides=overrides + [ALLOW_NEGATIVE_HEADSETS])
+def return_accessory(kind, barcode=None, name=None, badge=None, dept=None, overrides=[]):
+    pool = POOLS[kind]
+    with POOL_LOCK:
+        if not pool.borrowed(name):
+            raise HeadsetUnavailable("No {} was found to check in".format(kind))
 
-        radio['status'] = CHECKED_OUT
-        radio['last_activity'] = time.time()
-        radio['checkout'] = {
-            'status': radio['status'],
-            'time': radio['last_activity'],
+        commit({'op': kind, 'entry': {
+            'type': kind,
+            'status': CHECKED_IN,
             'borrower': name,
+            'time': time.time(),
             'department': dept,
             'badge': badge,
             'barcode': barcode,
-            'headset': headset,
-        }
-        radio['history'].append(radio['checkout'])
-
-        log(CHECKED_OUT, radio['last_activity'], id, name, badge, dept, headset)
-        save_db()
-    except IndexError:
-        raise RadioNotFound("Radio does not exist")
+        }})
 
 def return_battery(barcode=None, name=None, badge=None, dept=None, overrides=[]):
-    global BATTERIES
-
-    for i, headset in enumerate(BATTERIES):
-        if headset['borrower'] == name:
-            del BATTERIES[i]
-            BATTERY_HISTORY.append({
-                'status': CHECKED_IN,
-                'borrower': name,
-                'time': time.time(),
-                'department': dept,
-                'badge': badge,
-                'barcode': barcode,
-            })
-            save_db()
-            return
-    raise HeadsetUnavailable("No battery was found to check in")
+    return_accessory('battery', barcode=barcode, name=name, badge=badge, dept=dept, overrides=overrides)
 
 def return_headset(barcode=None, name=None, badge=None, dept=None, overrides=[]):
-    global HEADSETS
-
-    for i, headset in enumerate(HEADSETS):
-        if headset['borrower'] == name:
-            del HEADSETS[i]
-            HEADSET_HISTORY.append({
-                'status': CHECKED_IN,
-                'borrower': name,
-                'time': time.time(),
-                'department': dept,
-                'badge': badge,
-                'barcode': barcode,
-            })
-            save_db()
-            return
-    raise HeadsetUnavailable("No headset was found to check in")
+    return_accessory('headset', barcode=barcode, name=name, badge=badge, dept=dept, overrides=overrides)
 
 def return_radio(id, headset, barcode=None, name=None, badge=None, overrides=[ALLOW_MISSING_HEADSET, ALLOW_EXTRA_HEADSET, ALLOW_WRONG_PERSON]):
     try:
-        radio = RADIOS[id]
+        with radio_lock(id):
+            radio = RADIOS[id]
 
-        headset_returned = False
+            headset_returned = False
 
-        if radio['status'] == CHECKED_IN and \
-           ALLOW_DOUBLE_RETURN not in overrides:
-            raise NotCheckedOut("Radio was already checked in")
-        elif name != radio['checkout']['borrower'] and \
-             ALLOW_WRONG_PERSON not in overrides:
-            raise WrongPerson("Radio was checked out by '{}'".format(radio['checkout']['borrower']))
+            if radio['status'] == CHECKED_IN and \
+               ALLOW_DOUBLE_RETURN not in overrides:
+                raise NotCheckedOut("Radio was already checked in")
+            elif name != radio['checkout']['borrower'] and \
+                 ALLOW_WRONG_PERSON not in overrides:
+                raise WrongPerson("Radio was checked out by '{}'".format(radio['checkout']['borrower']))
 
-        name = name or radio['checkout']['borrower']
+            name = name or radio['checkout']['borrower']
 
-        radio['status'] = CHECKED_IN
-        radio['last_activity'] = time.time()
-
-        radio['checkout'] = {
-            'status': radio['status'],
-            'time': radio['last_activity'],
-            'borrower': name or radio['checkout']['borrower'],
-            'department': radio['checkout']['department'],
-            'badge': badge or radio['checkout']['badge'],
-            'headset': None,
-            'barcode': barcode or radio['checkout']['barcode'],
-        }
-
-        if headset:
-            return_headset(barcode=radio['checkout']['barcode'],
-                           name=radio['checkout']['borrower'],
-                           badge=radio['checkout']['badge'],
-                           dept=radio['checkout']['department'])
-            headset_returned = True
-
-        radio['history'].append(radio['checkout'])
-
-        RADIOS[id] = radio
-
-        log(CHECKED_IN, radio['last_activity'], id, '', '', '', headset)
-        save_db()
-
-        _, headsets_out, batteries_out = get_totals(get_person_history(name))
-
-        return headset_returned, headsets_out, batteries_out
+            checkin = {
+                'status': CHECKED_IN,
+                'time': time.time(),
+                'borrower': name or radio['checkout']['borrower'],
+                'department': radio['checkout']['department'],
+                'badge': badge or radio['checkout']['badge'],
+                'headset': None,
+                'barcode': barcode or radio['checkout'].get('barcode'),
+            }
+
+            if headset:
+                return_headset(barcode=checkin['barcode'],
+                               name=checkin['borrower'],
+                               badge=checkin['badge'],
+                               dept=checkin['department'])
+                headset_returned = True
+
+            commit({'op': 'radio', 'id': id, 'checkout': checkin})
+
+        return headset_returned, borrower_accessories(name)
     except IndexError:
         raise RadioNotFound("Radio does not exist")
 
 def lookup_badge(barcode):
+    if ROSTER:
+        res = ROSTER.lookup(barcode)
+        if res:
+            return res
+
     if UBER:
-        res = UBER.barcode.lookup_attendee_from_barcode(barcode_value=barcode)
-        if 'error' in res:
-            raise ValueError(res['error'])
-        return res['full_name'], res['badge_num']
+        res = UBER.lookup(barcode)
+        if not res:
+            raise ValueError('Barcode {} not found'.format(barcode))
+        return res
     else:
         raise ValueError('Uber not set up')
 
-def get_person_info():
+def get_person_info(data):
+    """
+Resolves whatever was typed or scanned into the name field. A badge scan is
+looked up in Uber; if that fails the text is used as the name as-is.
+    """
     barcode, name, badge = None, None, None
 
-    data = get_person()
     if BARCODE_RE.match(data.strip()):
-        barcode = data
-        while True:
-            try:
-                name, badge = lookup_badge(barcode)
-                break
-            except Exception as e:
-                print(e)
-                barcode = None
-                name = data
-                break
+        barcode = data.strip()
+        try:
+            name, badge = lookup_badge(barcode)
+        except (ValueError, badges.LookupFailed) as e:
+            print(e)
+            barcode = None
+            name = data
     else:
         name = data
 
@@ -508,67 +1211,81 @@ def get_person_info():
 
 configure('config.json')
 
-@APP.route('/headsetin', methods=['POST'])
-def headset_in():
+@APP.before_request
+def catch_up():
+    # Mutations sync under the exclusive lock instead
+    if SHARED and request.method == 'GET':
+        with shared_state():
+            pass
+
+def accessory_in(kind):
     args = request.form
 
     if args.get('borrower'):
         try:
-            return_headset(name=args.get('borrower'), dept=args.get('department'))
+            return_accessory(kind, name=args.get('borrower'), dept=args.get('department'))
             return flask.redirect(request.args.get('page', '/') + '?ok')
         except OverrideException as e:
             return flask.redirect('/?err=' + str(urllib.quote_plus(e.args[0])))
     else:
         return flask.redirect('/?err=Name+and+department+are+required')
 
-@APP.route('/headsetout', methods=['POST'])
-def headset_out():
+def accessory_out(kind):
     args = request.form
 
     if args.get('borrower') and args.get('department'):
         try:
-            checkout_headset(name=args.get('borrower'), dept=args.get('department'))
+            checkout_accessory(kind, name=args.get('borrower'), dept=args.get('department'))
             return flask.redirect(request.args.get('page', '/') + '?ok')
         except OverrideException as e:
             return flask.redirect('/?err=' + str(urllib.quote_plus(e.args[0])))
     else:
         return flask.redirect('/?err=Name+and+department+are+required')
 
+@APP.route('/accessory/<kind>/in', methods=['POST'])
+@exclusive
+def any_accessory_in(kind):
+    if kind not in POOLS:
+        return flask.redirect('/?err=Unknown+accessory')
+    return accessory_in(kind)
+
+@APP.route('/accessory/<kind>/out', methods=['POST'])
+@exclusive
+def any_accessory_out(kind):
+    if kind not in POOLS:
+        return flask.redirect('/?err=Unknown+accessory')
+    return accessory_out(kind)
+
+@APP.route('/headsetin', methods=['POST'])
+@exclusive
+def headset_in():
+    return accessory_in('headset')
+
+@APP.route('/headsetout', methods=['POST'])
+@exclusive
+def headset_out():
+    return accessory_out('headset')
+
 @APP.route('/batteryin', methods=['POST'])
+@exclusive
 def battery_in():
-    args = request.form
-
-    if args.get('borrower'):
-        try:
-            return_battery(name=args.get('borrower'), dept=args.get('department'))
-            return flask.redirect(request.args.get('page', '/') + '?ok')
-        except OverrideException as e:
-            return flask.redirect('/?err=' + str(urllib.quote_plus(e.args[0])))
-    else:
-        return flask.redirect('/?err=Name+and+department+are+required')
+    return accessory_in('battery')
 
 @APP.route('/batteryout', methods=['POST'])
+@exclusive
 def battery_out():
-    args = request.form
-
-    if args.get('borrower') and args.get('department'):
-        try:
-            checkout_battery(name=args.get('borrower'), dept=args.get('department'))
-            return flask.redirect(request.args.get('page', '/') + '?ok')
-        except OverrideException as e:
-            return flask.redirect('/?err=' + str(urllib.quote_plus(e.args[0])))
-    else:
-        return flask.redirect('/?err=Name+and+department+are+required')
+    return accessory_out('battery')
 
 
 @APP.route('/checkin', methods=['POST'])
+@exclusive
 def checkin():
     args = request.form
 
     if args.get('id'):
         try:
-            headset_returned, has_headset, has_battery = return_radio(args.get('id'), False)
-            if has_headset or has_battery or headset_returned:
+            headset_returned, accessories_out = return_radio(args.get('id'), False)
+            if headset_returned or any(accessories_out.values()):
                 return flask.redirect('/?check')
             return flask.redirect(request.args.get('page', '/') + '?ok')
         except OverrideException as e:
@@ -592,13 +1309,137 @@ def checkout():
     if not id:
         return flask.redirect('/?err=Stop+messing+with+stuff')
 
+    # Badge scans may be looked up in Uber, so that's done before locking
+    barcode, name, badge = get_person_info(name)
+
     try:
-        checkout_radio(id, dept, name=name, headset=bool(headset), overrides=[])
+        with exclusive_state():
+            checkout_radio(id, dept, name=name, badge=badge, barcode=barcode, headset=bool(headset), overrides=[])
     except OverrideException as e:
         if e.args:
             return flask.redirect('/?err=' + str(e.args[0]).replace(' ', '+'))
     return flask.redirect(request.args.get('page', '/') + '?ok')
 
+def required(item, *fields):
+    missing = [field for field in fields if not item.get(field)]
+    if missing:
+        raise ValueError("'{}' must be set".format("', '".join(missing)))
+
+def check_fields(item):
+    """
+Rejects fields of a /batch item that have the wrong type, so they fail that
+item rather than the whole request.
+    """
+    for field in ('name', 'department', 'type', 'badge', 'barcode'):
+        if item.get(field) is not None and not isinstance(item[field], str):
+            raise ValueError("'{}' must be a string".format(field))
+
+    if item.get('id') is not None and (isinstance(item['id'], bool) or not isinstance(item['id'], (str, int))):
+        raise ValueError("'id' must be a string or number")
+
+    overrides = item.get('overrides', [])
+    if not isinstance(overrides, list) or not all(isinstance(override, str) for override in overrides):
+        raise ValueError("'overrides' must be a list of override names")
+
+def batch_kind(item, kind):
+    if kind == 'accessory':
+        required(item, 'type')
+        kind = item['type']
+
+    if kind not in POOLS:
+        raise ValueError("Unknown accessory '{}'".format(kind))
+    return kind
+
+def batch_item(item):
+    """
+Runs one operation from a /batch request. Overrides add to the ones the
+matching form route already allows.
+    """
+    check_fields(item)
+    op = item.get('op')
+    overrides = item.get('overrides', [])
+
+    unknown = [override for override in overrides if override not in OVERRIDES]
+    if unknown:
+        raise ValueError("Unknown override {}".format(', '.join(unknown)))
+
+    if op == 'checkout':
+        required(item, 'id', 'name', 'department')
+        checkout_radio(str(item['id']), item['department'], name=item['name'], badge=item.get('badge'),
+                       barcode=item.get('barcode'), headset=bool(item.get('headset')), overrides=overrides)
+        return {}
+    elif op == 'checkin':
+        required(item, 'id')
+        headset_returned, accessories_out = return_radio(
+            str(item['id']), bool(item.get('headset')), name=item.get('name'),
+            overrides=[ALLOW_MISSING_HEADSET, ALLOW_EXTRA_HEADSET, ALLOW_WRONG_PERSON] + overrides)
+        res = {POOLS[kind].plural + '_out': out for kind, out in accessories_out.items()}
+        res['headset_returned'] = headset_returned
+        return res
+    elif op in ('headsetout', 'batteryout', 'accessoryout'):
+        required(item, 'name', 'department')
+        checkout_accessory(batch_kind(item, op[:-len('out')]), item['department'], name=item['name'],
+                           overrides=[ALLOW_NEGATIVE_HEADSETS] + overrides)
+        return {}
+    elif op in ('headsetin', 'batteryin', 'accessoryin'):
+        required(item, 'name')
+        return_accessory(batch_kind(item, op[:-len('in')]), name=item['name'], dept=item.get('department'), overrides=overrides)
+        return {}
+    else:
+        raise ValueError("Unknown op '{}'".format(op))
+
+@APP.route('/batch', methods=['POST'])
+def batch_json():
+    """
+Applies a list of operations, e.g. kitting a department out with 30 radios,
+all or nothing, and persists them once. Takes a JSON list (or {"items": [...]})
+of objects with an 'op' of checkout, checkin, headsetout, headsetin,
+batteryout, batteryin, or accessoryout and accessoryin with the kind of
+accessory as 'type', their fields as in the form routes, and optionally
+'overrides', a list of ALLOW_* names. Every item is checked, against the state
+including the items before it; if any fail, nothing is applied.
+    """
+    items = request.get_json(silent=True)
+    if isinstance(items, dict):
+        items = items.get('items')
+
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return flask.jsonify({"error": 400, "message": "Expected a list of operations"}), 400
+
+    # Badge scans are looked up before taking any locks
+    for item in items:
+        if item.get('op') == 'checkout' and isinstance(item.get('name'), str) and item['name']:
+            item['barcode'], item['name'], item['badge'] = get_person_info(item['name'])
+
+    results = []
+    try:
+        with contextlib.ExitStack() as locks:
+            locks.enter_context(exclusive_state())
+
+            ids = sorted({str(item['id']) for item in items if str(item.get('id')) in RADIOS})
+            for id in ids:
+                locks.enter_context(radio_lock(id))
+            locks.enter_context(POOL_LOCK)
+            locks.enter_context(LOCK)
+
+            with batch():
+                for item in items:
+                    try:
+                        results.append(dict(batch_item(item), ok=True))
+                    except (OverrideException, RadioNotFound, ValueError) as e:
+                        results.append({
+                            'ok': False,
+                            'error': str(e.args[0]) if e.args else type(e).__name__,
+                            'override': getattr(e, 'override', None),
+                        })
+
+                if not all(result['ok'] for result in results):
+                    raise BatchFailed()
+    except BatchFailed:
+        return flask.jsonify({'ok': False, 'results': results}), 409
+
+    return flask.jsonify({'ok': True, 'version': VERSION, 'results': results})
+
 def set_locked(radio, locked):
     pass
 
@@ -610,6 +1451,7 @@ def lock():
 
 
 @APP.route('/newradio', methods=['POST'])
+@exclusive
 def newradio():
     args = request.form
 
@@ -624,11 +1466,11 @@ def newradio():
         except:
             raise InvalidID("Invalid radio ID")
 
-        if str(radio) in RADIOS:
-            raise RadioExists("Radio {} already exists".format(radio))
+        with LOCK:
+            if str(radio) in RADIOS:
+                raise RadioExists("Radio {} already exists".format(radio))
 
-        RADIOS[radio] = get_blank_radio()
-        save_db()
+            commit({'op': 'new_radio', 'id': radio, 'time': time.time()})
     except (OverrideException, CreateRadioException) as e:
         if e.args:
             return flask.redirect('/?err=' + str(e.args[0]).replace(' ', '+'))
@@ -636,30 +1478,47 @@ def newradio():
     return flask.redirect(request.args.get('page', '/') + '?ok')
 
 @APP.route('/bulkadd', methods=['GET', 'POST'])
+@exclusive
 def bulkadd():
+    """
+Adds radios from ids and ranges ("1-800") typed into the form and/or an
+uploaded CSV with an 'id' column and any radio info. Everything is checked
+before anything is added, then it's all committed at once; with 'dry_run'
+set, or if there were any problems, only the report is shown.
+    """
+    template = ENV.get_template(TEMPLATE_BULK_ADD)
+
     if request.method == 'GET':
-        template = ENV.get_template(TEMPLATE_BULK_ADD)
         return template.render()
 
     args = request.form
 
-    radios = args.get('radios', '').split()
+    rows = provision.spec_rows(args.get('radios', ''))
 
-    try:
-        for radio in radios:
-            try:
-                assert int(radio) > 0
-            except:
-                raise InvalidID("Invalid radio ID")
+    upload = request.files.get('csv')
+    if upload and upload.filename:
+        # Streamed, so a big upload is never read into memory all at once
+        rows = itertools.chain(rows, provision.read_csv(codecs.iterdecode(upload.stream, 'utf-8-sig')))
 
-            if str(radio) in RADIOS:
-                raise RadioExists("Radio {} already exists".format(radio))
+    with LOCK:
+        add, errors = provision.plan(rows, RADIOS)
 
-            RADIOS[radio] = get_blank_radio()
-        save_db()
-    except (OverrideException, CreateRadioException) as e:
-        if e.args:
-            return flask.redirect('?err=' + str(e.args[0]).replace(' ', '+'))
+        if not add and not errors:
+            errors = [(None, 'No radios given')]
+
+        if errors or args.get('dry_run'):
+            return template.render(
+                report=True,
+                errors=errors,
+                count=len(add),
+                ranges=provision.ranges(id for id, _ in add),
+                with_info=sum(1 for _, info in add if info),
+                dry_run=bool(args.get('dry_run')),
+            )
+
+        now = time.time()
+        commit(*(dict({'op': 'new_radio', 'id': id, 'time': now}, **({'info': info} if info else {}))
+                 for id, info in add))
 
     return flask.redirect(request.args.get('page', '/') + '?ok')
 
@@ -670,10 +1529,29 @@ def radios(id):
 
     radio = RADIOS[str(id)]
 
-    template = ENV.get_template(TEMPLATE_RADIO)
-    return template.render(
+    # The entry kept from before ARCHIVED is shown from the archive
+    live = radio['history'][bisect_time(radio['history'], ARCHIVED, lambda evt: evt['time']):]
+    page, older = history_page(live, archived=lambda before, n: [evt for _, _, evt in ARCHIVE.history(before, n, radio=id)])
+
+    return stream_template(
+        TEMPLATE_RADIO,
         id=id,
         radio=radio,
+        history=page,
+        older=older,
+        paged=paged(),
+    )
+
+@APP.route('/radio/<id>/row')
+def radio_row(id):
+    if id not in RADIOS:
+        return flask.abort(404)
+
+    template = ENV.get_template(TEMPLATE_ROW)
+    return template.render(
+        id=id,
+        radio=RADIOS[id],
+        departments=CONFIG.get("departments", {}),
     )
 
 @APP.route('/radio/<id>.json')
@@ -683,15 +1561,177 @@ def radio_json(id):
 
     return flask.jsonify(RADIOS[str(id)])
 
+def radio_fields(fields):
+    return {id: {field: radio[field] for field in fields if field in radio} for id, radio in RADIOS.items()}
+
 @APP.route('/radios.json')
 def radios_json():
-    return flask.jsonify(RADIOS)
+    # A radio being added mid-serialization would break the iteration
+    with LOCK:
+        if request.args.get('fields'):
+            return flask.jsonify(radio_fields(request.args['fields'].split(',')))
+
+        return flask.jsonify(RADIOS)
+
+def event_stream(since):
+    while True:
+        with FEED:
+            if since == VERSION:
+                FEED.wait(CONFIG.get('sse_keepalive', 15))
+            evts = changes_since(since)
+            version = VERSION
+
+        if evts is None and since > version:
+            # The database was replaced, so the page may not even fit it
+            yield 'event: reload\ndata: {}\n\n'
+            return
+
+        if evts is None:
+            # We reloaded everything, so there's no telling what changed
+            yield 'id: {}\nevent: refresh\ndata: {{}}\n\n'.format(version)
+            since = version
+            continue
+
+        if not evts:
+            yield ': keepalive\n\n'
+
+        for evt in evts:
+            yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(evt['version'], evt['op'], json.dumps(evt))
+            since = evt['version']
+
+@APP.route('/events')
+def events():
+    """
+Server-Sent Events stream of every mutation. Subscribers just wait on FEED,
+so run gunicorn with gevent workers to hold lots of them open cheaply. In
+shared mode the poller picks up other workers' writes for all of them.
+    """
+    try:
+        since = int(request.headers.get('Last-Event-ID') or request.args.get('since', VERSION))
+    except ValueError:
+        since = VERSION
+
+    return flask.Response(event_stream(since), mimetype='text/event-stream',
+                          headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@APP.route('/changes')
+def changes():
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return flask.jsonify({"error": 400, "message": "'since' must be a version number"}), 400
+
+    with LOCK:
+        evts = changes_since(since)
+        if evts is not None:
+            return flask.jsonify({"version": VERSION, "changes": evts})
+
+        return flask.jsonify({
+            "version": VERSION,
+            "snapshot": dict(
+                {pool.plural: pool.entries() for pool in POOLS.values()},
+                radios=radio_fields(('status', 'last_activity', 'checkout')),
+            ),
+        })
+
+@APP.route('/departments.json')
+def departments_json():
+    depts = {}
+
+    for name in set(LIMITS) | set(DEPT_TOTALS) | {name for pool in POOLS.values() for name in pool.departments}:
+        if not name:
+            continue
+
+        depts[name] = {POOLS[kind].plural: out for kind, out in department_accessories(name).items()}
+        depts[name].update({
+            'limit': LIMITS.get(name, UNLIMITED),
+            'radios': department_total(name),
+        })
+
+    return flask.jsonify(depts)
+
+def parse_time(text):
+    """
+Reads a time given as a Unix timestamp or an ISO date and time in local time,
+as sent by a datetime-local input.
+    """
+    try:
+        return float(text)
+    except ValueError:
+        return time.mktime(datetime.datetime.fromisoformat(text).timetuple())
+
+def state_at(timestamp):
+    index_history()
+    with LOCK:
+        if ARCHIVE and timestamp < ARCHIVED:
+            # Rare enough that replaying the archive up to then will do
+            state = ARCHIVE.state_at(timestamp)
+        else:
+            state = TIMELINE.at(timestamp)
+
+    radios = sorted(state['radios'].items(), key=lambda item: int(item[0]))
+    loans = {kind: sorted((loan for out in borrowers.values() for loan in out), key=lambda loan: loan['time'])
+             for kind, borrowers in state['accessories'].items()}
+
+    # Counts of everything out per department, by kind
+    depts = {}
+    for kind, out in itertools.chain([('radio', [checkout for _, checkout in radios if checkout['status'] == CHECKED_OUT])],
+                                     loans.items()):
+        for evt in out:
+            counts = depts.setdefault(evt['department'], {})
+            counts[kind] = counts.get(kind, 0) + 1
+
+    return {
+        'time': timestamp,
+        'radios': radios,
+        'accessories': loans,
+        'departments': depts,
+    }
+
+@APP.route('/state.json')
+def state_json():
+    try:
+        state = state_at(parse_time(request.args.get('at', '')) if request.args.get('at') else time.time())
+    except ValueError:
+        return flask.jsonify({"error": 400, "message": "'at' must be a timestamp or an ISO date"}), 400
+
+    state['radios'] = dict(state['radios'])
+    return flask.jsonify(state)
+
+@APP.route('/state')
+def state_page():
+    try:
+        state = state_at(parse_time(request.args.get('at', '')) if request.args.get('at') else time.time())
+    except ValueError:
+        return flask.redirect('/state?err=Invalid+time')
+
+    template = ENV.get_template(TEMPLATE_STATE)
+    return template.render(
+        at=datetime.datetime.fromtimestamp(state['time']).strftime('%Y-%m-%dT%H:%M:%S'),
+        error=request.args.get('err'),
+        kinds=list(POOLS),
+        **state
+    )
 
 @APP.route('/people.json')
 def people_json():
     return flask.jsonify(PEOPLE)
 
+@APP.route('/autocomplete')
+def autocomplete_json():
+    try:
+        limit = min(int(request.args.get('limit', 10)), 100)
+    except ValueError:
+        return flask.jsonify({"error": 400, "message": "'limit' must be a number"}), 400
+
+    # No lock: the index is only ever inserted into or swapped whole, and a
+    # suggestion that's a moment out of date does no harm
+    index_history()
+    return flask.jsonify([{'name': name, 'badges': badges}
+                          for name, badges in NAMES.search(request.args.get('q', ''), limit)])
+
 @APP.route('/associate', methods=['POST'])
+@exclusive
 def associate():
     new_id = request.args.get('id', None)
     new_owner = request.args.get('name', None)
@@ -704,157 +1744,259 @@ def associate():
 
     old_owner = PEOPLE.get(str(new_id), None)
 
-    PEOPLE[str(new_id)] = new_owner
-
-    save_db()
+    commit({'op': 'person', 'id': str(new_id), 'name': new_owner, 'time': time.time()})
 
     return flask.jsonify({"prev_name": old_owner, "name": new_owner, "id": new_id})
 
-def get_person_history(name):
-    evts = []
-
-    for id, radio in RADIOS.items():
-        for evt in radio['history']:
-            if evt['borrower'] == name:
-                newevt = {'type': 'radio', 'id': id}
-                newevt.update(evt)
-                evts.append(newevt)
-
-    for evt in HEADSET_HISTORY:
-        if evt['borrower'] == name:
-            newevt = {'type': 'headset'}
-            newevt.update(evt)
-            evts.append(newevt)
-
-    for evt in BATTERY_HISTORY:
-        if evt['borrower'] == name:
-            newevt = {'type': 'battery'}
-            newevt.update(evt)
-            evts.append(newevt)
-
-    return evts
+def history_entry(type, id, evt):
+    newevt = {'type': type, 'id': id} if id else {'type': type}
+    newevt.update(evt)
+    return newevt
 
-def get_dept_history(name):
-    evts = []
-
-    for id, radio in RADIOS.items():
-        for evt in radio['history']:
-            if evt['department'] == name:
-                newevt = {'type': 'radio', 'id': id}
-                newevt.update(evt)
-                evts.append(newevt)
-
-    for evt in HEADSET_HISTORY:
-        if evt['department'] == name:
-            newevt = {'type': 'headset'}
-            newevt.update(evt)
-            evts.append(newevt)
-
-    for evt in BATTERY_HISTORY:
-        if evt['department'] == name:
-            newevt = {'type': 'battery'}
-            newevt.update(evt)
-            evts.append(newevt)
-
-    return evts
+def indexed_history(index, name, since=None, **archived):
+    """
+Every event filed under `name` from `since` on, oldest first. The archive is
+only read when `since` is before what the live state has.
+    """
+    index_history()
+    evts = [entry for entry in index.get(name, {}).get('history', []) if since is None or entry[2]['time'] >= since]
+    if ARCHIVE and (since is None or since < ARCHIVED):
+        evts[:0] = ARCHIVE.history(ARCHIVED, since=since, **archived)[::-1]
+    return [history_entry(*entry) for entry in evts]
+
+def get_person_history(name, since=None):
+    return indexed_history(BORROWERS, name, since, borrower=name)
+
+def get_dept_history(name, since=None):
+    return indexed_history(DEPARTMENTS, name, since, department=name)
+
+def bisect_time(evts, timestamp, time_of):
+    lo, hi = 0, len(evts)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if time_of(evts[mid]) < timestamp:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
 
+def history_page(evts, time_of=lambda evt: evt['time'], archived=None):
+    """
+Picks one page, newest first, out of a time-ordered history according to
+?page=N or ?before=<time>:<n>, for the events from up to <time> less the <n>
+newest from exactly then, which earlier pages showed. Returns the page and
+the `before` cursor for the next older page, or None if this is the oldest.
 
-def get_totals(evts):
-    radios, headsets, batteries = 0, 0, 0
+Pages that run past the start of `evts` are filled from `archived`, called
+as archived(before, n) for the n newest archived events from before then.
+    """
+    size = CONFIG.get('history_page_size', 100)
+    # The archive is read from before `before`, less the `shown` newest
+    before, shown, skip = ARCHIVED, 0, 0
 
-    for evt in evts:
-        if evt['type'] == 'radio':
-            if evt['status'] == CHECKED_IN:
-                radios -= 1
-            elif evt['status'] == CHECKED_OUT:
-                radios += 1
-        elif evt['type'] == 'headset':
-            if evt['status'] == CHECKED_IN:
-                headsets -= 1
-            elif evt['status'] == CHECKED_OUT:
-                headsets += 1
-        elif evt['type'] == 'battery':
-            if evt['status'] == CHECKED_IN:
-                batteries -= 1
-            elif evt['status'] == CHECKED_OUT:
-                batteries += 1
-
-    return radios, headsets, batteries
+    try:
+        if 'before' in request.args:
+            at, _, n = request.args['before'].partition(':')
+            at, n = float(at), int(n or 0)
+            end = max(bisect_time(evts, math.nextafter(at, math.inf), time_of) - n, 0)
+            if at < ARCHIVED:
+                before, shown = math.nextafter(at, math.inf), n
+        else:
+            end = len(evts) - (max(int(request.args.get('page', 1)), 1) - 1) * size
+            # Pages wholly past the live history skip that much of the archive
+            skip = max(-end, 0)
+            end = max(end, 0)
+    except ValueError:
+        end = len(evts)
+
+    start = max(end - size, 0)
+
+    page = evts[start:end][::-1]
+    if start > 0:
+        at = time_of(evts[start])
+        return page, '{}:{}'.format(at, bisect_time(evts, math.nextafter(at, math.inf), time_of) - start)
+
+    if not ARCHIVE or archived is None:
+        return page, None
+
+    need = size - len(page)
+    older = archived(before, skip + shown + need + 1)[skip + shown:]
+    page.extend(older[:need])
+    if len(older) <= need:
+        return page, None
+
+    at = time_of(page[-1])
+    n = sum(1 for evt in page if time_of(evt) == at)
+    # Still on the same moment as the last page
+    if before == math.nextafter(at, math.inf):
+        n += shown
+    return page, '{}:{}'.format(at, n)
+
+def paged():
+    return 'page' in request.args or 'before' in request.args
+
+def stream_template(template, **context):
+    return flask.Response(ENV.get_template(template).generate(**context))
 
 @APP.route('/person/<name>')
 def person(name):
-    evts = get_person_history(name)
-
-    radios, headsets, batteries = get_totals(evts)
+    index_history()
+    page, older = history_page(BORROWERS.get(name, {}).get('history', []), lambda entry: entry[2]['time'],
+                               lambda before, n: ARCHIVE.history(before, n, borrower=name))
 
-    out_radios = []
+    radios = borrower_total(name)
 
-    for id, radio in RADIOS.items():
-        if radio['status'] == CHECKED_OUT and radio['checkout']['borrower'] == name:
-            out_radios.append((id, radio['checkout']))
+    out_radios = [(id, RADIOS[id]['checkout']) for id in
+                  sorted(BORROWERS.get(name, {}).get('radios', []), key=int)]
 
-    template = ENV.get_template(TEMPLATE_PERSON)
-    return template.render(
+    return stream_template(
+        TEMPLATE_PERSON,
         name=name,
-        history=evts,
+        history=(history_entry(*entry) for entry in page),
+        older=older,
+        paged=paged(),
         radios=radios,
-        headsets=headsets,
-        batteries=batteries,
+        accessories=[(POOLS[kind], out) for kind, out in borrower_accessories(name).items() if out],
         out_radios=out_radios,
     )
 
 
 @APP.route('/dept/<name>')
 def dept(name):
-    evts = get_dept_history(name)
-
-    radios, headsets, batteries = 0, 0, 0
+    index_history()
+    page, older = history_page(DEPARTMENTS.get(name, {}).get('history', []), lambda entry: entry[2]['time'],
+                               lambda before, n: ARCHIVE.history(before, n, department=name))
 
-    out_radios = []
+    radios = department_total(name)
 
-    for id, radio in RADIOS.items():
-        if radio['status'] == CHECKED_OUT and radio['checkout']['department'] == name:
-            out_radios.append((id, radio['checkout']))
+    out_radios = [(id, RADIOS[id]['checkout']) for id in
+                  sorted(DEPARTMENTS.get(name, {}).get('radios', []), key=int)]
 
-    for evt in evts:
-        if evt['type'] == 'radio':
-            if evt['status'] == CHECKED_IN:
-                radios -= 1
-            elif evt['status'] == CHECKED_OUT:
-                radios += 1
-        elif evt['type'] == 'headset':
-            if evt['status'] == CHECKED_IN:
-                headsets -= 1
-            elif evt['status'] == CHECKED_OUT:
-                radios += 1
-        elif evt['type'] == 'battery':
-            if evt['status'] == CHECKED_IN:
-                batteries -= 1
-            elif evt['status'] == CHECKED_OUT:
-                batteries += 1
-
-    template = ENV.get_template(TEMPLATE_DEPT)
-    return template.render(
+    return stream_template(
+        TEMPLATE_DEPT,
         name=name,
-        history=evts,
+        history=(history_entry(*entry) for entry in page),
+        older=older,
+        paged=paged(),
         radios=radios,
-        headsets=headsets,
-        batteries=batteries,
+        accessories=[(POOLS[kind], out) for kind, out in department_accessories(name).items() if out],
         out_radios=out_radios,
     )
 
-@APP.route('/printable')
-def printable():
-    template = ENV.get_template(TEMPLATE_PRINTABLE)
-    return template.render(
-        radios=sorted(RADIOS.items(), key=lambda k:int(k[0])),
-        headsets=HEADSET_TOTAL-len(HEADSETS),
-        batteries=BATTERY_TOTAL-len(BATTERIES),
-        headsets_out=HEADSETS,
-        batteries_out=BATTERIES,
+def inventory():
+    return dict(
+        radios=[(id, RADIOS[id]) for _, id in RADIO_ORDER],
+        accessories=list(POOLS.values()),
         departments=CONFIG.get("departments", {})
     )
 
+def cached_render(template, context):
+    """
+Renders a page that only depends on the state, reusing the last render until
+VERSION changes. Relative times go stale, so renders also expire every
+'render_cache_ttl' seconds. Returns (etag, body).
+    """
+    # Under LOCK, so a batch that's still going (and may yet be reverted)
+    # isn't rendered
+    with LOCK:
+        key = (VERSION, GENERATION, int(time.time() // CONFIG.get('render_cache_ttl', 60)))
+
+        cached = RENDER_CACHE.get(template)
+        if not cached or cached[0] != key:
+            cached = RENDER_CACHE[template] = (key, ENV.get_template(template).render(**context()))
+
+    return '{}-{}-{}'.format(*key), cached[1]
+
+def usage_stats():
+    """
+Statistics for /stats, recomputed at most once per version and
+'render_cache_ttl' seconds like the cached pages.
+    """
+    global STATS
+
+    index_history()
+
+    with LOCK:
+        key = (VERSION, GENERATION, int(time.time() // CONFIG.get('render_cache_ttl', 60)))
+        if not STATS or STATS[0] != key:
+            STATS = (key, ANALYTICS.stats(time.time(), radios=len(RADIOS)))
+        return STATS[1]
+
+def conditional(etag, body):
+    resp = flask.make_response(body)
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp.make_conditional(request)
+
+@APP.route('/stats.json')
+def stats_json():
+    if not ANALYTICS:
+        return flask.jsonify({"error": 501, "message": "Usage statistics need NumPy installed"}), 501
+
+    return flask.jsonify(usage_stats())
+
+@APP.route('/stats')
+def stats_page():
+    if not ANALYTICS:
+        return flask.redirect('/?err=Usage+statistics+need+NumPy+installed')
+
+    # Not from inside cached_render, which holds LOCK while an index build
+    # may be waiting on it to finish
+    stats = usage_stats()
+    return conditional(*cached_render(TEMPLATE_STATS, lambda: dict(stats=stats)))
+
+def overdue_entry(now, kind, key, entry):
+    return dict(entry, type=kind, id=key if kind == 'radio' else None, out_for=now - entry['time'])
+
+def overdue_report(now, n, dept=None):
+    """
+What's past its department's 'overdue_after' threshold and the `n` items out
+longest, overall or in one department, without looking at anything else out.
+    """
+    with LOCK:
+        return {
+            'time': now,
+            'overdue': [overdue_entry(now, *item) for item in OVERDUE.overdue(now, dept)],
+            'oldest': [overdue_entry(now, *item) for item in OVERDUE.oldest(n, dept)],
+            'departments': {name: summary for name, summary in OVERDUE.summary(now).items() if name},
+        }
+
+def overdue_count():
+    n = int(request.args.get('n', 20))
+    # A negative count would slice from the other end
+    if n < 0:
+        raise ValueError("Negative count {}".format(n))
+    return n
+
+@APP.route('/overdue.json')
+def overdue_json():
+    try:
+        n = overdue_count()
+    except ValueError:
+        return flask.jsonify({"error": 400, "message": "'n' must be a number, 0 or more"}), 400
+
+    return flask.jsonify(overdue_report(time.time(), n, request.args.get('dept') or None))
+
+@APP.route('/overdue')
+def overdue_page():
+    try:
+        n = overdue_count()
+    except ValueError:
+        return flask.redirect('/overdue?err=Invalid+count')
+
+    dept = request.args.get('dept') or None
+    template = ENV.get_template(TEMPLATE_OVERDUE)
+    return template.render(
+        dept=dept,
+        n=n,
+        error=request.args.get('err'),
+        **overdue_report(time.time(), n, dept)
+    )
+
+@APP.route('/printable')
+def printable():
+    return conditional(*cached_render(TEMPLATE_PRINTABLE, inventory))
+
 @APP.route('/')
 def index():
     args = request.args
@@ -872,16 +2014,12 @@ def index():
     if 'check' in args:
         warn = "Success! Please check in user&apos;s remaining accessories."
 
-    template = ENV.get_template(TEMPLATE_INDEX)
-    return template.render(
-        msg=msg, error=err, warn=warn,
-        radios=sorted(RADIOS.items(), key=lambda k:int(k[0])),
-        headsets=HEADSET_TOTAL-len(HEADSETS),
-        batteries=BATTERY_TOTAL-len(BATTERIES),
-        headsets_out=HEADSETS,
-        batteries_out=BATTERIES,
-        departments=CONFIG.get("departments", {})
-    )
+    banner = str(ENV.get_template(TEMPLATE_MACROS).module.banner(err, msg, warn))
+
+    etag, body = cached_render(TEMPLATE_INDEX, lambda: dict(inventory(), banner=BANNER, version=VERSION))
+
+    return conditional('{}-{:x}'.format(etag, zlib.crc32(banner.encode('utf-8'))),
+                       body.replace(BANNER, banner, 1))
 
 if __name__ == "__main__":
     APP.run('0.0.0.0', port=80, debug=True)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+import csv
+import json
+import heapq
+import bisect
+import itertools
+import collections
+
+CHECKED_IN = 'CHECKED_IN'
+CHECKED_OUT = 'CHECKED_OUT'
+
+# Every event in radios.log is one row with these columns; ops that don't use
+# a column leave it blank. 'person' events keep the name under 'borrower', and
+# 'new_radio' events keep any radio info as JSON under 'info'.
+COLUMNS = ('op', 'version', 'time', 'id', 'status', 'borrower', 'department', 'badge', 'barcode', 'headset', 'info')
+
+# Events from several workers can reach the log slightly out of order, so
+# replay sorts them by version within a window this many events wide
+REORDER_WINDOW = 1000
+
+
+def event_row(evt):
+    """
+Flattens a committed event into a radios.log row.
+    """
+    op = evt['op']
+    if op == 'radio':
+        fields = dict(evt['checkout'], id=evt['id'])
+    elif 'entry' in evt:
+        fields = evt['entry']
+    elif op == 'person':
+        fields = {'id': evt['id'], 'borrower': evt['name'], 'time': evt['time']}
+    else:
+        fields = dict(evt, info=json.dumps(evt['info']) if evt.get('info') else None)
+
+    fields = dict(fields, op=op, version=evt.get('version'))
+    return ['' if fields.get(col) is None else fields[col] for col in COLUMNS]
+
+
+def value(text):
+    if text == '':
+        return None
+    if text in ('True', 'False'):
+        return text == 'True'
+    try:
+        return int(text)
+    except ValueError:
+        return text
+
+
+def row_event(row):
+    """
+Parses a radios.log row back into an event. Rows written before the log was
+typed (CHECKED_OUT/CHECKED_IN, time, radio, name, badge, dept, headset) come
+back as radio events without a version or barcode.
+    """
+    if row[0] in (CHECKED_OUT, CHECKED_IN):
+        status, time, id, name, badge, dept, headset = row[:7]
+        return {'op': 'radio', 'version': None, 'id': id, 'checkout': {
+            'status': status,
+            'time': float(time),
+            'borrower': name or None,
+            'department': dept or None,
+            'badge': value(badge),
+            'barcode': None,
+            'headset': value(headset),
+        }}
+
+    # Rows logged before 'info' was added have one column fewer
+    op, version, time, id, status, name, dept, badge, barcode, headset = row[:10]
+    evt = {'op': op, 'version': int(version) if version else None, 'time': float(time or 0)}
+
+    if op == 'radio':
+        evt['id'] = id
+        evt['checkout'] = {
+            'status': status,
+            'time': evt['time'],
+            'borrower': name or None,
+            'department': dept or None,
+            'badge': value(badge),
+            'barcode': barcode or None,
+            'headset': headset == 'True' if headset else None,
+        }
+    elif op == 'person':
+        evt['id'] = id
+        evt['name'] = name
+    elif op == 'new_radio':
+        evt['id'] = id
+        if len(row) > 10 and row[10]:
+            evt['info'] = json.loads(row[10])
+    elif op == 'archive':
+        # Moved older history out of radioman's state; the log still has it
+        pass
+    else:
+        # Any other op is a kind of accessory
+        evt['entry'] = {
+            'type': op,
+            'status': status,
+            'time': evt['time'],
+            'borrower': name or None,
+            'department': dept or None,
+            'badge': value(badge),
+            'barcode': barcode or None,
+        }
+
+    return evt
+
+
+def read_events(paths):
+    """
+Streams the events from each log file in turn, putting events from
+different workers back into version order.
+    """
+    buffer, seq = [], itertools.count()
+    for path in paths:
+        with open(path, newline='') as f:
+            for row in csv.reader(f):
+                if not row:
+                    continue
+
+                evt = row_event(row)
+                heapq.heappush(buffer, (evt['version'] or 0, next(seq), evt))
+                if len(buffer) > REORDER_WINDOW:
+                    yield heapq.heappop(buffer)[2]
+
+    while buffer:
+        yield heapq.heappop(buffer)[2]
+
+
+def blank_radio():
+    checkout = {'status': CHECKED_IN, 'department': None, 'borrower': None, 'badge': None, 'headset': None, 'time': 0}
+    return {'status': CHECKED_IN, 'last_activity': 0, 'history': [dict(checkout)], 'checkout': checkout}
+
+
+def replay(evts):
+    """
+Rebuilds the database, in the radios.json layout, from a stream of events
+in a single pass.
+    """
+    radios, people, history, version = {}, {}, [], 0
+
+    # Loans still out, in the order they went out, and each borrower's queue
+    # of them; returns close the borrower's oldest loan, as in radioman
+    loans, queues = {}, {}
+    loan_ids = itertools.count()
+
+    for evt in evts:
+        op = evt['op']
+        if op == 'radio':
+            checkout = evt['checkout']
+            radio = radios.get(evt['id'])
+            if radio is None:
+                radio = radios[evt['id']] = blank_radio()
+
+            # Old-style check-in rows didn't say who returned the radio
+            if checkout['status'] == CHECKED_IN and not checkout['borrower']:
+                checkout['borrower'] = radio['checkout']['borrower']
+                checkout['department'] = radio['checkout']['department']
+
+            radio['status'] = checkout['status']
+            radio['last_activity'] = checkout['time']
+            radio['checkout'] = checkout
+            radio['history'].append(checkout)
+        elif 'entry' in evt:
+            entry = dict(evt['entry'], type=op)
+            queue = queues.setdefault(op, {}).setdefault(entry['borrower'], collections.deque())
+            if entry['status'] == CHECKED_OUT:
+                loan = next(loan_ids)
+                loans.setdefault(op, {})[loan] = entry
+                queue.append(loan)
+            elif queue:
+                del loans[op][queue.popleft()]
+            history.append(entry)
+        elif op == 'person':
+            people[evt['id']] = evt['name']
+        elif op == 'new_radio':
+            radio = radios.setdefault(evt['id'], blank_radio())
+            if evt.get('info'):
+                radio['info'] = evt['info']
+
+        version = evt['version'] or version
+
+    return {
+        'radios': radios,
+        'accessories': {kind: list(out.values()) for kind, out in loans.items()},
+        'accessory_history': history,
+        'people': people,
+        'audits': [],
+        'version': version,
+    }
+
+
+def step(state, op, id, entry):
+    if op == 'radio':
+        state['radios'][id] = entry
+    else:
+        loans = state['accessories'].setdefault(op, {}).setdefault(entry['borrower'], [])
+        if entry['status'] == CHECKED_OUT:
+            loans.append(entry)
+        elif loans:
+            loans.pop(0)
+
+
+def copy_state(state):
+    return {
+        'radios': dict(state['radios']),
+        'accessories': {kind: {name: list(loans) for name, loans in borrowers.items() if loans}
+                        for kind, borrowers in state['accessories'].items()},
+    }
+
+
+class Timeline(object):
+    """
+Every radio and accessory event in time order, for working out what was out
+at any moment. A snapshot of the state is kept every `interval` events, so a
+query costs a bisect plus replaying at most `interval` events. Snapshots are
+taken the first time a query needs them.
+    """
+
+    def __init__(self, interval=1000):
+        self.interval = interval
+        self.load([])
+
+    def load(self, entries):
+        """
+Replaces the timeline with (time, op, id, entry) tuples, in any order.
+        """
+        entries = sorted(entries, key=lambda entry: entry[0])
+        self.times = [entry[0] for entry in entries]
+        self.events = [entry[1:] for entry in entries]
+        self.checkpoints = [{'radios': {}, 'accessories': {}}]
+
+    def add(self, time, op, id, entry):
+        i = bisect.bisect_right(self.times, time)
+        self.times.insert(i, time)
+        self.events.insert(i, (op, id, entry))
+
+        # Snapshots taken after an event that arrived late are wrong now
+        del self.checkpoints[i // self.interval + 1:]
+
+    def remove(self, time, entry):
+        i = bisect.bisect_right(self.times, time)
+        while i > 0 and self.times[i - 1] == time:
+            i -= 1
+            if self.events[i][2] is entry:
+                del self.times[i]
+                del self.events[i]
+                del self.checkpoints[i // self.interval + 1:]
+                return
+
+    def at(self, time):
+        """
+Returns the state as of `time`: 'radios' maps each radio that existed to its
+checkout entry, and 'accessories' maps each kind to its borrowers' loans.
+        """
+        end = bisect.bisect_right(self.times, time)
+        k = end // self.interval
+
+        while len(self.checkpoints) <= k:
+            n = len(self.checkpoints)
+            state = copy_state(self.checkpoints[-1])
+            for evt in self.events[(n - 1) * self.interval:n * self.interval]:
+                step(state, *evt)
+            self.checkpoints.append(state)
+
+        state = copy_state(self.checkpoints[k])
+        for evt in self.events[k * self.interval:end]:
+            step(state, *evt)
+        return state
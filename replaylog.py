@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# Rebuilds a lost or damaged database from radios.log. Pass the rotated logs
+# oldest first, then the current one:
+#
+#   ./replaylog.py radios.json radios.log.2* radios.log
+#
+# Then point "db" in config.json at the new file (and move any old journal
+# out of the way, since its entries are already in the log).
+
+import os
+import sys
+import time
+import storage
+import replay
+
+if len(sys.argv) < 3:
+    print("Usage: {} radios.json radios.log...".format(sys.argv[0]))
+    sys.exit(1)
+
+dst, logs = sys.argv[1], sys.argv[2:]
+
+if os.path.exists(dst):
+    print("{} already exists; move it aside first".format(dst))
+    sys.exit(1)
+
+start = time.time()
+data = replay.replay(replay.read_events(logs))
+
+storage.JSONStorage(dst).save(data)
+
+print("Rebuilt {} radios and {} accessories out, up to version {}, in {:.1f}s".format(
+    len(data['radios']), sum(len(loans) for loans in data['accessories'].values()), data['version'], time.time() - start))
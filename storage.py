@@ -0,0 +1,679 @@
+#!/usr/bin/env python3
+import os
+import csv
+import json
+import time
+import fcntl
+import atexit
+import sqlite3
+import threading
+import itertools
+import contextlib
+import accessories
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CHECKED_IN = 'CHECKED_IN'
+CHECKED_OUT = 'CHECKED_OUT'
+
+SQLITE_EXTENSIONS = ('.sqlite', '.sqlite3', '.db')
+
+
+def dumps(data):
+    """
+Serializes to UTF-8 JSON, with orjson when it's installed since it's several
+times faster on a big database. Anything orjson won't take (non-string keys,
+huge ints) falls back to json.
+    """
+    if orjson:
+        try:
+            return orjson.dumps(data)
+        except TypeError:
+            pass
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def loads(text):
+    return orjson.loads(text) if orjson else json.loads(text)
+
+
+class Storage(object):
+    """
+Base class for the radio database backends. The in-memory state in radioman
+is always authoritative while running; a backend only needs to load it back
+at startup and persist each committed event.
+
+Besides load(), each backend has save(data), which replaces the whole
+database with a snapshot in the radios.json layout, and record(evts, state),
+which persists committed events. `state` is a callable returning the full
+snapshot, for backends that can only write the whole thing.
+checkpoint(state) compacts whatever record() has built up.
+    """
+
+    def load(self):
+        """
+Returns (data, events): a snapshot in the radios.json layout plus any
+events that were persisted after it and still need to be applied.
+        """
+        return {}, []
+
+    def catch_up(self, version):
+        """
+Returns the events other processes have persisted after `version`, for
+backends that can read just those. Anything else gets reloaded in full.
+        """
+        return []
+
+
+class JSONStorage(Storage):
+    def __init__(self, path, lock=None):
+        self.path = path
+        # Held while building and serializing the snapshot, since request
+        # threads may be changing the state when we're flushed from the
+        # group commit thread
+        self.lock = lock or threading.RLock()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                return loads(f.read()), []
+        except FileNotFoundError:
+            with open(self.path, 'w') as f:
+                json.dump({}, f)
+            return {}, []
+
+    def save(self, data):
+        self.write(lambda: data)
+
+    def record(self, evts, state):
+        self.write(state)
+
+    def checkpoint(self, state):
+        self.write(state)
+
+    def write(self, state):
+        with self.lock:
+            text = dumps(state())
+
+        # Write to a temp file and rename it over the old one, so a crash
+        # never leaves a truncated database behind
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+
+
+class JournalStorage(JSONStorage):
+    """
+JSON snapshot plus an append-only journal with one event per line. The
+journal is folded into a new snapshot every `checkpoint_interval` entries.
+    """
+
+    def __init__(self, path, journal, checkpoint_interval=1000, lock=None):
+        super(JournalStorage, self).__init__(path, lock=lock)
+        self.journal = journal
+        self.checkpoint_interval = checkpoint_interval
+        self.entries = 0
+        # How far into the journal we've read or written
+        self.offset = 0
+
+    def load(self):
+        data, _ = super(JournalStorage, self).load()
+        version = data.get('version', 0)
+
+        evts = []
+        self.entries = 0
+        self.offset = 0
+        try:
+            with open(self.journal, 'rb+') as f:
+                offset = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError("Partial journal entry")
+                        evt = loads(line)
+                    except ValueError:
+                        # A crash mid-append leaves a partial last line behind;
+                        # drop it so later appends start on a clean line
+                        f.truncate(offset)
+                        break
+
+                    offset += len(line)
+                    self.entries += 1
+                    # Entries already folded into the snapshot are skipped, in
+                    # case we crashed between writing it and emptying the
+                    # journal, as are any appended twice by a retried write
+                    if evt['version'] > version:
+                        evts.append(evt)
+                        version = evt['version']
+                self.offset = offset
+        except FileNotFoundError:
+            pass
+
+        return data, evts
+
+    def catch_up(self, version):
+        evts = []
+        offset = self.offset
+        try:
+            with open(self.journal, 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    try:
+                        evt = loads(line)
+                    except ValueError:
+                        # Compacted under us, so we're no longer on a line boundary
+                        return []
+
+                    offset += len(line)
+                    if evt['version'] <= version + len(evts):
+                        continue
+                    if evt['version'] != version + len(evts) + 1:
+                        return []
+                    evts.append(evt)
+        except FileNotFoundError:
+            return []
+
+        self.offset = offset
+        self.entries += len(evts)
+        return evts
+
+    def record(self, evts, state):
+        self.append(evts)
+
+        if self.entries >= self.checkpoint_interval:
+            try:
+                self.checkpoint(state)
+            except Exception as e:
+                # The events are already in the journal, so this only puts off
+                # folding them in; it mustn't look like they weren't written
+                print('Failed to checkpoint, will retry on the next write: {}'.format(e))
+
+    def append(self, evts):
+        with open(self.journal, 'ab') as f:
+            f.write(b''.join(dumps(evt) + b'\n' for evt in evts))
+            f.flush()
+            os.fsync(f.fileno())
+            self.offset = f.tell()
+        self.entries += len(evts)
+
+    def checkpoint(self, state):
+        self.write(state)
+        open(self.journal, 'w').close()
+        self.entries = 0
+        self.offset = 0
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS radios (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    time REAL NOT NULL DEFAULT 0,
+    borrower TEXT,
+    department TEXT,
+    badge TEXT,
+    barcode TEXT,
+    headset INTEGER,
+    info TEXT
+);
+
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    type TEXT NOT NULL,
+    radio TEXT,
+    status TEXT NOT NULL,
+    time REAL NOT NULL DEFAULT 0,
+    borrower TEXT,
+    department TEXT,
+    badge TEXT,
+    barcode TEXT,
+    headset INTEGER
+);
+-- For trimming archived events, which finds each radio's last one
+CREATE INDEX IF NOT EXISTS events_radio ON events (radio, seq);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+
+CREATE TABLE IF NOT EXISTS loans (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    type TEXT NOT NULL,
+    status TEXT NOT NULL,
+    time REAL NOT NULL DEFAULT 0,
+    borrower TEXT,
+    department TEXT,
+    badge TEXT,
+    barcode TEXT
+);
+-- For closing a borrower's oldest loan
+CREATE INDEX IF NOT EXISTS loans_borrower ON loans (type, borrower);
+
+CREATE TABLE IF NOT EXISTS people (
+    id TEXT PRIMARY KEY,
+    name TEXT
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+-- Lookups are all made in memory, so these only slowed down writes
+DROP INDEX IF EXISTS radios_status;
+DROP INDEX IF EXISTS radios_department;
+DROP INDEX IF EXISTS radios_borrower;
+DROP INDEX IF EXISTS events_borrower;
+DROP INDEX IF EXISTS events_department;
+DROP INDEX IF EXISTS loans_department;
+DROP INDEX IF EXISTS people_name;
+"""
+
+EVENT_FIELDS = ('status', 'time', 'borrower', 'department', 'badge', 'barcode', 'headset')
+LOAN_FIELDS = ('status', 'time', 'borrower', 'department', 'badge', 'barcode')
+
+
+def _bool(value):
+    return None if value is None else bool(value)
+
+
+class SQLiteStorage(Storage):
+    """
+Stores radios, their checkout events, outstanding accessory loans and people
+in indexed tables, so each mutation is a handful of single-row statements.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+        # Databases created before radios had info are missing the column
+        if 'info' not in [row['name'] for row in self.conn.execute('PRAGMA table_info(radios)')]:
+            self.conn.execute('ALTER TABLE radios ADD COLUMN info TEXT')
+
+    def _event(self, row):
+        evt = {field: row[field] for field in EVENT_FIELDS}
+        evt['headset'] = _bool(evt['headset'])
+        return evt
+
+    def _loan(self, row):
+        loan = {field: row[field] for field in LOAN_FIELDS}
+        loan['type'] = row['type']
+        return loan
+
+    def load(self):
+        with self.lock:
+            radios = {}
+            for row in self.conn.execute('SELECT * FROM radios'):
+                checkout = self._event(row)
+                radios[row['id']] = {
+                    'status': row['status'],
+                    'last_activity': row['time'],
+                    'checkout': checkout,
+                    'history': [],
+                }
+                if row['info']:
+                    radios[row['id']]['info'] = json.loads(row['info'])
+
+            data = {
+                'radios': radios,
+                'accessories': {},
+                'accessory_history': [],
+                'people': {},
+                'audits': [],
+                'version': 0,
+            }
+
+            for row in self.conn.execute('SELECT * FROM events ORDER BY seq'):
+                if row['type'] == 'radio':
+                    if row['radio'] in radios:
+                        radios[row['radio']]['history'].append(self._event(row))
+                else:
+                    data['accessory_history'].append(self._loan(row))
+
+            for row in self.conn.execute('SELECT * FROM loans ORDER BY seq'):
+                data['accessories'].setdefault(row['type'], []).append(self._loan(row))
+
+            for row in self.conn.execute('SELECT id, name FROM people'):
+                data['people'][row['id']] = row['name']
+
+            for row in self.conn.execute('SELECT key, value FROM meta'):
+                data[row['key']] = json.loads(row['value'])
+
+        return data, []
+
+    def _insert_event(self, type, evt, radio=None):
+        self.conn.execute('INSERT INTO events (type, radio, status, time, borrower, department, badge, barcode, headset) '
+                          'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                          (type, radio) + tuple(evt.get(field) for field in EVENT_FIELDS))
+
+    def _update_radio(self, id, checkout, info=None):
+        # An upsert rather than INSERT OR REPLACE, which would drop the info
+        self.conn.execute('INSERT INTO radios (id, status, time, borrower, department, badge, barcode, headset) '
+                          'VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET '
+                          'status = excluded.status, time = excluded.time, borrower = excluded.borrower, '
+                          'department = excluded.department, badge = excluded.badge, '
+                          'barcode = excluded.barcode, headset = excluded.headset',
+                          (id,) + tuple(checkout.get(field) for field in EVENT_FIELDS))
+        if info:
+            self.conn.execute('UPDATE radios SET info = ? WHERE id = ?', (json.dumps(info), id))
+
+    def _insert_loan(self, type, entry):
+        self.conn.execute('INSERT INTO loans (type, status, time, borrower, department, badge, barcode) '
+                          'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          (type,) + tuple(entry.get(field) for field in LOAN_FIELDS))
+
+    def _set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def record(self, evts, state):
+        with self.lock, self.conn:
+            for evt in evts:
+                op = evt['op']
+                if op == 'radio':
+                    self._update_radio(evt['id'], evt['checkout'])
+                    self._insert_event('radio', evt['checkout'], radio=evt['id'])
+                elif 'entry' in evt:
+                    entry = evt['entry']
+                    if entry['status'] == CHECKED_OUT:
+                        self._insert_loan(op, entry)
+                    else:
+                        self.conn.execute('DELETE FROM loans WHERE seq = '
+                                          '(SELECT seq FROM loans WHERE type = ? AND borrower = ? ORDER BY seq LIMIT 1)',
+                                          (op, entry['borrower']))
+                    self._insert_event(op, entry)
+                elif op == 'person':
+                    self.conn.execute('INSERT OR REPLACE INTO people (id, name) VALUES (?, ?)', (evt['id'], evt['name']))
+                elif op == 'new_radio':
+                    blank = {'status': CHECKED_IN, 'time': 0}
+                    self._update_radio(evt['id'], blank, evt.get('info'))
+                    self._insert_event('radio', blank, radio=evt['id'])
+                elif op == 'archive':
+                    self._trim_events(evt['time'])
+
+            if evts:
+                self._set_meta('version', evts[-1]['version'])
+
+    def _trim_events(self, before):
+        # Keeps the same events archive.split_radio and split_accessories do
+        self.conn.execute("DELETE FROM events WHERE type = 'radio' AND time < ? AND seq NOT IN "
+                          "(SELECT MAX(seq) FROM events WHERE type = 'radio' AND time < ? GROUP BY radio)",
+                          (before, before))
+
+        rows = self.conn.execute("SELECT seq, type, status, borrower FROM events "
+                                 "WHERE type != 'radio' AND time < ? ORDER BY seq", (before,)).fetchall()
+        kept = {rows[i]['seq'] for i in accessories.open_loans(rows)}
+        self.conn.executemany('DELETE FROM events WHERE seq = ?', [(row['seq'],) for row in rows if row['seq'] not in kept])
+
+        self._set_meta('archived', before)
+
+    def save(self, data):
+        """
+Replaces the whole database with a snapshot in the radios.json layout.
+        """
+        with self.lock, self.conn:
+            for table in ('radios', 'events', 'loans', 'people', 'meta'):
+                self.conn.execute('DELETE FROM ' + table)
+
+            for id, radio in data.get('radios', {}).items():
+                self._update_radio(str(id), dict(radio['checkout'], status=radio['status']), radio.get('info'))
+                for entry in radio.get('history', []):
+                    self._insert_event('radio', entry, radio=str(id))
+
+            loans, history = accessories.read_db(data)
+            for entry in history:
+                self._insert_event(entry['type'], entry)
+
+            for type, entries in loans.items():
+                for entry in entries:
+                    self._insert_loan(type, entry)
+
+            for id, name in data.get('people', {}).items():
+                self.conn.execute('INSERT INTO people (id, name) VALUES (?, ?)', (str(id), name))
+
+            self._set_meta('audits', data.get('audits', []))
+            self._set_meta('version', data.get('version', 0))
+            self._set_meta('archived', data.get('archived', 0))
+
+    def checkpoint(self, state):
+        with self.lock:
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+class GroupCommit(Storage):
+    """
+Wraps another backend so committed events are queued and written from a
+background thread, at most every `interval` seconds or as soon as
+`threshold` events are waiting. Anything still queued is flushed at exit.
+    """
+
+    def __init__(self, backend, interval=0.5, threshold=100):
+        self.backend = backend
+        self.interval = interval
+        self.threshold = threshold
+
+        self.pending = []
+        self.state = None
+        self.cond = threading.Condition()
+        self.flushing = threading.Lock()
+
+        self.thread = threading.Thread(target=self.run, name='group-commit')
+        self.thread.daemon = True
+        self.thread.start()
+
+        atexit.register(self.flush)
+
+    def load(self):
+        return self.backend.load()
+
+    def save(self, data):
+        self.flush()
+        self.backend.save(data)
+
+    def record(self, evts, state):
+        with self.cond:
+            self.pending.extend(evts)
+            self.state = state
+            self.cond.notify()
+
+    def checkpoint(self, state):
+        self.flush()
+        self.backend.checkpoint(state)
+
+    def flush(self):
+        with self.flushing:
+            with self.cond:
+                batch, self.pending = self.pending, []
+
+            if batch:
+                try:
+                    self.backend.record(batch, self.state)
+                except Exception as e:
+                    # Backends only raise for events they didn't write
+                    print('Failed to write {} events, will retry: {}'.format(len(batch), e))
+                    with self.cond:
+                        self.pending[:0] = batch
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+
+                deadline = time.time() + self.interval
+                while len(self.pending) < self.threshold and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+
+            self.flush()
+
+
+class LogWriter(object):
+    """
+Appends CSV rows to a log file from a background thread, so requests only
+have to queue them. Rows are written in batches every `interval` seconds and
+at exit. The file is rotated to `<path>.<timestamp>` once it reaches
+`max_bytes`, or at the first write of a new day if `daily` is set.
+    """
+
+    def __init__(self, path, interval=1, max_bytes=0, daily=False):
+        self.path = path
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.daily = daily
+
+        self.pending = []
+        self.cond = threading.Condition()
+        self.flushing = threading.Lock()
+        self.file = None
+        self.writer = None
+
+        self.thread = threading.Thread(target=self.run, name='log-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+        atexit.register(self.flush)
+
+    def write(self, *fields):
+        with self.cond:
+            self.pending.append(fields)
+            self.cond.notify()
+
+    def open(self):
+        if self.file:
+            # Another worker may have rotated the file out from under us
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self.file.fileno()).st_ino:
+                    return
+            except FileNotFoundError:
+                pass
+            self.file.close()
+
+        self.file = open(self.path, 'a', newline='')
+        self.writer = csv.writer(self.file, lineterminator='\n')
+
+    def rotate(self):
+        now = time.localtime()
+        stat = os.fstat(self.file.fileno())
+        # Going by the file's age rather than anything of ours, since another
+        # worker may already have started today's
+        stale = self.daily and time.strftime('%Y-%m-%d', time.localtime(stat.st_mtime)) != time.strftime('%Y-%m-%d', now)
+
+        if stat.st_size and ((self.max_bytes and stat.st_size >= self.max_bytes) or stale):
+            self.file.close()
+            self.file = None
+            try:
+                current = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                current = None
+
+            # Unless another worker has just rotated it
+            if current == stat.st_ino:
+                rotated = '{}.{}'.format(self.path, time.strftime('%Y%m%d-%H%M%S', now))
+                for n in itertools.count(1):
+                    if not os.path.exists(rotated):
+                        break
+                    rotated = '{}.{}.{}'.format(self.path, time.strftime('%Y%m%d-%H%M%S', now), n)
+                os.rename(self.path, rotated)
+            self.open()
+
+    def flush(self):
+        with self.flushing:
+            with self.cond:
+                batch, self.pending = self.pending, []
+
+            if batch:
+                try:
+                    self.open()
+                    self.rotate()
+                    self.writer.writerows(batch)
+                    self.file.flush()
+                except (OSError, IOError) as e:
+                    print('Failed to write {} lines to {}, will retry: {}'.format(len(batch), self.path, e))
+                    with self.cond:
+                        self.pending[:0] = batch
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+
+            time.sleep(self.interval)
+            self.flush()
+
+
+class SharedLock(object):
+    """
+Coordinates several worker processes using the same database. An flock()ed
+lock file serializes them, and a stamp file holds the version of the last
+write so each worker can tell cheaply whether it has fallen behind.
+    """
+
+    def __init__(self, path):
+        self.path = path + '.lock'
+        self.stamp = path + '.version'
+        self.file = None
+        self.pid = None
+
+    @contextlib.contextmanager
+    def hold(self, exclusive=True):
+        # Workers forked after we were created need their own open file,
+        # or they would all share (and never block on) one lock
+        if self.pid != os.getpid():
+            self.file = open(self.path, 'a+')
+            self.pid = os.getpid()
+
+        # A blocking flock() would stall every greenlet in a gevent worker,
+        # so we poll for it instead; time.sleep is gevent's there
+        mode = (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB
+        wait = 0.001
+        while True:
+            try:
+                fcntl.flock(self.file, mode)
+                break
+            except BlockingIOError:
+                time.sleep(wait)
+                wait = min(wait * 2, 0.05)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def read_stamp(self):
+        try:
+            with open(self.stamp) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write_stamp(self, version):
+        with open(self.stamp, 'w') as f:
+            f.write(str(version))
+
+
+def get_storage(config, lock=None):
+    """
+Picks a backend from the config: an SQLite file when 'db' has an SQLite
+extension, a journaled JSON file when 'journal' is set, else plain JSON.
+With 'durability' set to 'grouped', writes go through a GroupCommit, except
+in 'shared' mode where other workers have to see every write right away.
+    """
+    db = config['db']
+    if os.path.splitext(db)[1] in SQLITE_EXTENSIONS:
+        backend = SQLiteStorage(db)
+    elif config.get('journal'):
+        backend = JournalStorage(db, config['journal'], config.get('checkpoint_interval', 1000), lock=lock)
+    else:
+        backend = JSONStorage(db, lock=lock)
+
+    if config.get('durability', 'sync') == 'grouped' and not config.get('shared'):
+        return GroupCommit(backend,
+                           interval=config.get('flush_interval', 500) / 1000.0,
+                           threshold=config.get('flush_threshold', 100))
+    return backend
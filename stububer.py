@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# Answers Uber's barcode lookups from a local file, for trying out badge
+# scanning without a connection to the real Uber:
+#
+#   ./stububer.py attendees.json [port] [delay]
+#
+# attendees.json maps barcodes to {"full_name": ..., "badge_num": ...}. Set
+# "uber": {"uri": "http://localhost:8282/jsonrpc"} in config.json to use it,
+# and pass a delay in seconds to see how the desk copes with a slow Uber.
+
+import sys
+import json
+import time
+import http.server
+
+if len(sys.argv) not in (2, 3, 4):
+    print("Usage: {} attendees.json [port] [delay]".format(sys.argv[0]))
+    sys.exit(1)
+
+with open(sys.argv[1]) as f:
+    ATTENDEES = json.load(f)
+
+PORT = int(sys.argv[2]) if len(sys.argv) > 2 else 8282
+DELAY = float(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+
+        if DELAY:
+            time.sleep(DELAY)
+
+        res = {'jsonrpc': '2.0', 'id': req.get('id')}
+        if req.get('method') != 'barcode.lookup_attendee_from_barcode':
+            res['error'] = {'code': -32601, 'message': 'Method not found'}
+        else:
+            barcode = req.get('params', {}).get('barcode_value')
+            res['result'] = ATTENDEES.get(barcode, {'error': 'Barcode {} not found'.format(barcode)})
+
+        body = json.dumps(res).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+print("Serving {} attendees on port {}".format(len(ATTENDEES), PORT))
+http.server.ThreadingHTTPServer(('', PORT), Handler).serve_forever()
@@ -0,0 +1,40 @@
+import os
+import sys
+import json
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def radioman(tmp_path, monkeypatch):
+    """
+Returns a function that imports radioman afresh, configured with a few
+radios and departments plus any settings passed to it, with its database and
+logs in a temporary directory.
+    """
+    def setup(**config):
+        conf = {
+            'radios': list(range(1, 16)),
+            'departments': {'TechOps': {'limit': None}, 'Arcade': {'limit': 2}, 'LAN': {'limit': 5}},
+            'headsets': 15,
+            'batteries': 15,
+            # Absolute, since background threads may write after the test
+            # has changed back out of tmp_path
+            'db': str(tmp_path / 'radios.json'),
+            'log': str(tmp_path / 'radios.log'),
+            'audit_log': str(tmp_path / 'audits.log'),
+        }
+        conf.update(config)
+        with open(str(tmp_path / 'config.json'), 'w') as f:
+            json.dump(conf, f)
+
+        # radioman configures itself from the working directory on import
+        monkeypatch.chdir(tmp_path)
+        os.symlink(os.path.join(ROOT, 'templates'), str(tmp_path / 'templates'))
+        sys.modules.pop('radioman', None)
+        import radioman
+        return radioman
+
+    return setup
@@ -0,0 +1,30 @@
+import archive
+
+
+def entry(time, borrower):
+    return {'time': time, 'status': 'CHECKED_OUT', 'borrower': borrower, 'department': 'Tech Ops'}
+
+
+def test_workers_see_each_others_writes(tmp_path):
+    first, second = archive.Archive(str(tmp_path)), archive.Archive(str(tmp_path))
+    # Both have read the (empty) index before either writes
+    assert first.history(float('inf')) == second.history(float('inf')) == []
+
+    first.write([('radio', 1, entry(100, 'Alice'))], 150)
+    second.write([('radio', 2, entry(200, 'Bob'))], 250)
+
+    found = archive.Archive(str(tmp_path)).history(float('inf'))
+    assert [(id, evt['borrower']) for _, id, evt in found] == [(2, 'Bob'), (1, 'Alice')]
+    assert first.borrowers() == second.borrowers() == {'Alice', 'Bob'}
+
+
+def test_records_another_worker_archived_are_skipped(tmp_path):
+    first, second = archive.Archive(str(tmp_path)), archive.Archive(str(tmp_path))
+    first.history(float('inf'))
+    second.history(float('inf'))
+
+    records = [('radio', 1, entry(100, 'Alice'))]
+    first.write(records, 150)
+    second.write(records, 150)
+
+    assert len(archive.Archive(str(tmp_path)).history(float('inf'))) == 1
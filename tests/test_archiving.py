@@ -0,0 +1,26 @@
+import time
+
+
+def test_nothing_to_archive_commits_nothing(radioman, tmp_path):
+    r = radioman(archive_dir=str(tmp_path / 'archive'), archive_after=100)
+    with r.LOCK:
+        r.archive_history(time.time())
+        version = r.VERSION
+        r.archive_history(time.time() + 50)
+        assert r.VERSION == version
+
+
+def test_archiving_keeps_the_history_indexes(radioman, tmp_path):
+    r = radioman(archive_dir=str(tmp_path / 'archive'), archive_after=100)
+    r.checkout_radio('1', 'TechOps', name='Alice')
+    r.return_radio('1', False)
+    r.index_history()
+
+    with r.LOCK:
+        r.archive_history(time.time() + 200)
+        assert r.INDEXED
+        assert r.BORROWERS['Alice']['history'] == []
+        assert r.TIMELINE.at(time.time() + 200)['radios']['1']['status'] == r.CHECKED_IN
+
+    assert [evt['status'] for _, _, evt in r.ARCHIVE.history(r.ARCHIVED, borrower='Alice')] == \
+        [r.CHECKED_IN, r.CHECKED_OUT]
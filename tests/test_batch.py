@@ -0,0 +1,76 @@
+import threading
+
+
+class Failed(Exception):
+    pass
+
+
+def reverted_checkout(r):
+    with r.LOCK:
+        try:
+            with r.batch():
+                r.checkout_radio('1', 'TechOps', name='Mallory')
+                yield
+                raise Failed()
+        except Failed:
+            pass
+
+
+def test_pages_wait_for_a_batch_to_finish(radioman):
+    r = radioman()
+    client = r.APP.test_client()
+    bodies = []
+
+    batch = reverted_checkout(r)
+    next(batch)
+    reader = threading.Thread(target=lambda: bodies.append(client.get('/').get_data(as_text=True)))
+    reader.start()
+    reader.join(0.5)
+    assert reader.is_alive()
+
+    next(batch, None)
+    reader.join()
+    assert 'Mallory' not in bodies[0]
+
+
+def test_reverted_batch_changes_the_etag(radioman):
+    r = radioman()
+    context = lambda: dict(r.inventory(), banner=None, version=r.VERSION)
+
+    with r.LOCK:
+        batch = reverted_checkout(r)
+        next(batch)
+        during, _ = r.cached_render(r.TEMPLATE_INDEX, context)
+        next(batch, None)
+
+    r.checkout_radio('2', 'TechOps', name='Alice')
+    after, body = r.cached_render(r.TEMPLATE_INDEX, context)
+    assert after != during
+    assert 'Mallory' not in body and 'Alice' in body
+
+
+def test_overdraft_override_covers_accessories(radioman):
+    r = radioman()
+    client = r.APP.test_client()
+    for _ in range(2):
+        r.checkout_accessory('headset', 'Arcade', name='Alice')
+
+    item = {'op': 'headsetout', 'name': 'Bob', 'department': 'Arcade'}
+    resp = client.post('/batch', json=[item])
+    assert resp.status_code == 409
+    assert resp.get_json()['results'][0]['override'] == 'ALLOW_DEPARTMENT_OVERDRAFT'
+
+    resp = client.post('/batch', json=[dict(item, overrides=['ALLOW_DEPARTMENT_OVERDRAFT'])])
+    assert resp.status_code == 200
+
+
+def test_badly_typed_items_fail_alone(radioman):
+    r = radioman()
+    client = r.APP.test_client()
+    for item in ({'op': 'checkout', 'id': 1, 'name': 'Alice', 'department': ['TechOps']},
+                 {'op': 'checkout', 'id': 1, 'name': 'Alice', 'department': 'TechOps', 'overrides': None},
+                 {'op': 'checkout', 'id': 1, 'name': 12, 'department': 'TechOps'},
+                 {'op': 'checkout', 'id': [1], 'name': 'Alice', 'department': 'TechOps'}):
+        resp = client.post('/batch', json=[item])
+        assert resp.status_code == 409
+        assert not resp.get_json()['results'][0]['ok']
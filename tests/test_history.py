@@ -0,0 +1,30 @@
+def walk(r, evts, archived=None):
+    seen, cursor = [], None
+    while True:
+        url = '/?before={}'.format(cursor) if cursor else '/'
+        with r.APP.test_request_context(url):
+            page, cursor = r.history_page(evts, archived=archived)
+        seen.extend(page)
+        if not cursor:
+            return seen
+
+
+def test_pages_split_between_events_at_the_same_time(radioman):
+    r = radioman(history_page_size=3)
+    evts = [{'time': time, 'n': n} for n, time in enumerate([1, 2, 2, 2, 2, 2, 3, 4, 4])]
+
+    assert walk(r, evts) == evts[::-1]
+
+
+def test_pages_split_between_archived_events_at_the_same_time(radioman, monkeypatch):
+    r = radioman(history_page_size=3)
+    old = [{'time': time, 'n': n} for n, time in enumerate([1, 2, 2, 2, 2, 2, 2, 2, 3])]
+    live = [{'time': time, 'n': n} for n, time in enumerate([5, 5, 6, 6], len(old))]
+    # Without an archiver running, which would move ARCHIVED itself
+    monkeypatch.setattr(r, 'ARCHIVE', object())
+    monkeypatch.setattr(r, 'ARCHIVED', 5)
+
+    def archived(before, n):
+        return [evt for evt in old if evt['time'] < before][::-1][:n]
+
+    assert walk(r, live, archived) == (old + live)[::-1]
@@ -0,0 +1,6 @@
+def test_negative_counts_are_rejected(radioman):
+    r = radioman()
+    client = r.APP.test_client()
+    assert client.get('/overdue.json?n=-1').status_code == 400
+    assert client.get('/overdue?n=-1').headers['Location'].endswith('/overdue?err=Invalid+count')
+    assert client.get('/overdue.json?n=0').get_json()['oldest'] == []
@@ -0,0 +1,65 @@
+import json
+import time
+import threading
+import storage
+
+
+def next_event(stream):
+    got = []
+    reader = threading.Thread(target=lambda: got.append(next(stream)))
+    reader.daemon = True
+    reader.start()
+    reader.join(5)
+    return got[0] if got else None
+
+
+def test_streams_get_other_workers_events(radioman, tmp_path):
+    r = radioman(shared=True, journal=str(tmp_path / 'radios.journal'), shared_poll_interval=10)
+    version = r.VERSION
+    stream = r.event_stream(version)
+
+    # Another worker's write, as it lands on disk
+    other = storage.JournalStorage(r.CONFIG['db'], r.CONFIG['journal'])
+    other.load()
+    other.append([{'op': 'person', 'id': '123', 'name': 'Alice', 'version': version + 1}])
+    r.SHARED.write_stamp(version + 1)
+
+    assert next_event(stream).startswith('id: {}\nevent: person\n'.format(version + 1))
+    assert r.PEOPLE['123'] == 'Alice'
+
+
+def test_streams_refresh_after_a_full_reload(radioman, tmp_path):
+    r = radioman(shared=True, shared_poll_interval=10)
+    version = r.VERSION
+    stream = r.event_stream(version)
+
+    with open(r.CONFIG['db']) as f:
+        data = json.load(f)
+    data['version'] = version + 1
+    with open(r.CONFIG['db'], 'w') as f:
+        json.dump(data, f)
+    r.SHARED.write_stamp(version + 1)
+
+    assert next_event(stream) == 'id: {}\nevent: refresh\ndata: {{}}\n\n'.format(version + 1)
+
+
+def test_badge_lookups_dont_hold_up_other_requests(radioman, monkeypatch):
+    r = radioman(shared=True)
+
+    class SlowUber(object):
+        def lookup(self, barcode):
+            time.sleep(1)
+            return 'Alice', 123
+
+    monkeypatch.setattr(r, 'UBER', SlowUber())
+    scan = threading.Thread(target=lambda: r.APP.test_client().post(
+        '/checkout', data={'id': '1', 'name': 'ABC123', 'department': 'TechOps'}))
+    scan.start()
+    time.sleep(0.2)
+
+    started = time.time()
+    assert r.APP.test_client().get('/').status_code == 200
+    assert time.time() - started < 0.5
+
+    scan.join()
+    assert r.RADIOS['1']['checkout']['borrower'] == 'Alice'
@@ -0,0 +1,45 @@
+import time
+import threading
+
+
+def test_stats_while_the_indexes_are_building(radioman, monkeypatch):
+    r = radioman()
+    r.index_history()
+    monkeypatch.setattr(r, 'INDEXED', False)
+
+    # Stands in for a build, which needs LOCK to swap in what it built
+    def build():
+        with r.INDEXING:
+            time.sleep(0.3)
+            with r.LOCK:
+                r.INDEXED = True
+
+    builder = threading.Thread(target=build)
+    builder.daemon = True
+    builder.start()
+    time.sleep(0.05)
+
+    got = []
+    reader = threading.Thread(target=lambda: got.append(r.APP.test_client().get('/stats').status_code))
+    reader.daemon = True
+    reader.start()
+    reader.join(5)
+    builder.join(5)
+
+    assert got == [200]
+
+
+def test_concurrency_by_department(radioman):
+    r = radioman()
+    r.checkout_radio('1', 'TechOps', name='Alice')
+    r.checkout_radio('2', 'TechOps', name='Bob')
+    r.checkout_radio('3', 'LAN', name='Carl')
+
+    stats = r.APP.test_client().get('/stats.json').get_json()
+    total = stats['radio']['concurrency']
+    departments = stats['radio']['departments']
+    assert [peak for _, peak in departments['TechOps']['concurrency']][-1] == 2
+    assert [peak for _, peak in departments['LAN']['concurrency']][-1] == 1
+    assert [start for start, _ in departments['LAN']['concurrency']] == [start for start, _ in total]
+
+    assert r.APP.test_client().get('/stats').status_code == 200
@@ -0,0 +1,88 @@
+import os
+import time
+import storage
+
+
+def events(*versions):
+    return [{'op': 'person', 'id': str(version), 'name': 'Alice', 'version': version} for version in versions]
+
+
+def test_failed_checkpoint_does_not_write_events_twice(tmp_path):
+    journal = storage.JournalStorage(str(tmp_path / 'radios.json'), str(tmp_path / 'radios.journal'),
+                                     checkpoint_interval=1)
+    grouped = storage.GroupCommit(journal, interval=60)
+
+    def state():
+        raise IOError('disk full')
+
+    grouped.record(events(1, 2, 3), state)
+    grouped.flush()
+    grouped.flush()
+
+    data, evts = storage.JournalStorage(str(tmp_path / 'radios.json'), str(tmp_path / 'radios.journal')).load()
+    assert [evt['version'] for evt in evts] == [1, 2, 3]
+
+
+def test_load_skips_entries_appended_twice(tmp_path):
+    journal = storage.JournalStorage(str(tmp_path / 'radios.json'), str(tmp_path / 'radios.journal'))
+    journal.load()
+    journal.append(events(1, 2, 3))
+    journal.append(events(1, 2, 3, 4))
+
+    data, evts = journal.load()
+    assert [evt['version'] for evt in evts] == [1, 2, 3, 4]
+    assert [evt['version'] for evt in journal.catch_up(0)] == []
+
+    reader = storage.JournalStorage(str(tmp_path / 'radios.json'), str(tmp_path / 'radios.journal'))
+    reader.load()
+    reader.offset = 0
+    assert [evt['version'] for evt in reader.catch_up(0)] == [1, 2, 3, 4]
+
+
+def test_shared_lock_waits_without_blocking(tmp_path, monkeypatch):
+    path = str(tmp_path / 'radios.json')
+    holder, waiter = storage.SharedLock(path), storage.SharedLock(path)
+    held = holder.hold()
+    held.__enter__()
+    waits = []
+
+    # Released from inside the wait, which a blocking flock() would never get to
+    def sleep(seconds):
+        if not waits:
+            held.__exit__(None, None, None)
+        waits.append(seconds)
+
+    monkeypatch.setattr(storage.time, 'sleep', sleep)
+    with waiter.hold(exclusive=False):
+        pass
+    assert len(waits) == 1
+
+
+def test_workers_rotate_a_days_log_once(tmp_path):
+    path = str(tmp_path / 'radios.log')
+    first, second = storage.LogWriter(path, interval=60, daily=True), storage.LogWriter(path, interval=60, daily=True)
+    for writer in (first, second):
+        writer.write('yesterday')
+        writer.flush()
+
+    yesterday = time.time() - 86400
+    os.utime(path, (yesterday, yesterday))
+    for writer in (first, second):
+        writer.write('today')
+        writer.flush()
+
+    rotated = [name for name in os.listdir(str(tmp_path)) if name.startswith('radios.log.')]
+    assert len(rotated) == 1
+    with open(path) as f:
+        assert f.read() == 'today\ntoday\n'
+
+
+def test_sqlite_keeps_only_the_indexes_it_queries_with(tmp_path):
+    path = str(tmp_path / 'radios.db')
+    db = storage.SQLiteStorage(path)
+    db.conn.execute('CREATE INDEX people_name ON people (name)')
+    db.conn.commit()
+
+    db = storage.SQLiteStorage(path)
+    indexes = {row['name'] for row in db.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")}
+    assert indexes == {'events_radio', 'events_time', 'loans_borrower'}
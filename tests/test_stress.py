@@ -0,0 +1,65 @@
+import random
+import threading
+import collections
+
+THREADS = 12
+REQUESTS = 100
+
+
+def test_concurrent_checkouts_and_checkins(radioman):
+    r = radioman()
+    ids = [str(id) for id in range(1, 16)]
+    # (radio, +1 for a checkout or -1 for a checkin) for every one that worked
+    done = collections.deque()
+    violations = []
+    running = True
+
+    def desk(seed):
+        rand = random.Random(seed)
+        client = r.APP.test_client()
+        for _ in range(REQUESTS):
+            id = rand.choice(ids)
+            if rand.random() < 0.5:
+                resp = client.post('/checkout', data={'id': id, 'name': 'desk{}'.format(seed),
+                                                      'department': rand.choice(sorted(r.LIMITS))})
+                delta = 1
+            else:
+                resp = client.post('/checkin', data={'id': id})
+                delta = -1
+            if 'err=' not in resp.headers['Location']:
+                done.append((id, delta))
+
+    def monitor():
+        while running:
+            with r.LOCK:
+                for dept, limit in r.LIMITS.items():
+                    if limit is not None and r.DEPT_TOTALS.get(dept, 0) > limit:
+                        violations.append((dept, r.DEPT_TOTALS[dept]))
+
+    watcher = threading.Thread(target=monitor)
+    watcher.start()
+    desks = [threading.Thread(target=desk, args=(seed,)) for seed in range(THREADS)]
+    for thread in desks:
+        thread.start()
+    for thread in desks:
+        thread.join()
+    running = False
+    watcher.join()
+
+    assert violations == []
+    assert len(done) > THREADS
+
+    # Every radio went out and came back in turn, ending up as the desks
+    # were told
+    for id in ids:
+        assert sum(delta for radio, delta in done if radio == id) == \
+            (1 if r.RADIOS[id]['status'] == r.CHECKED_OUT else 0)
+
+        statuses = [evt['status'] for evt in r.RADIOS[id]['history']]
+        assert all(a != b for a, b in zip(statuses, statuses[1:]))
+
+    out = collections.Counter(radio['checkout']['department'] for radio in r.RADIOS.values()
+                              if radio['status'] == r.CHECKED_OUT)
+    assert {dept: total for dept, total in r.DEPT_TOTALS.items() if total} == dict(out)
+    for dept, limit in r.LIMITS.items():
+        assert limit is None or out[dept] <= limit